@@ -0,0 +1,273 @@
+import argparse
+import os
+import sys
+import json
+import time
+import resource
+import gzip
+import struct
+import subprocess as sp
+from os.path import join, exists, abspath, dirname
+
+parser = argparse.ArgumentParser(description='Throughput benchmark for seg, fsra.py and datastock.py on a synthetic cohort. \
+    Builds fake FreeSurfer and hMRI trees, puts stub segmentation/recon-all tools on the PATH and reports subjects/hour, \
+    scan latency, bytes copied and peak memory.')
+parser.add_argument('-n', '--sizes', help='Cohort sizes to run; default: 10 1000 10000', nargs='+', type=int, default=[10, 1000, 10000])
+parser.add_argument('-d', '--dir', help='Where to build the synthetic data; default: bench/', default='bench', metavar='[path]')
+parser.add_argument('-p', '--pipelines', help='Pipelines to run; default: all', nargs='+', choices=['seg', 'fsra', 'datastock'],
+    default=['seg', 'fsra', 'datastock'])
+parser.add_argument('-u', '--unit', help='Seconds the slowest stub (segmentHA_T2.sh) sleeps, the others take a fixed share of it; default: 0.05',
+    type=float, default=0.05)
+parser.add_argument('-b', '--burn', help='CPU share of each stub run, 0 only sleeps, 1 only burns; default: 0.5', type=float, default=0.5)
+parser.add_argument('-k', '--kb', help='Size of each synthetic image in kB; default: 64', type=int, default=64)
+parser.add_argument('-t', '--threads', help='Threads for seg (total budget); default: number of cores', type=int, default=os.cpu_count())
+parser.add_argument('-w', '--workers', help='Concurrent subjects for seg; default: 4', type=int, default=4)
+parser.add_argument('-s', '--scratch', help='Run seg with local scratch staging', action='store_true', default=False)
+parser.add_argument('-f', '--fsraMax', help='Most subjects pushed through fsra.py at each size, it copies the whole subject; default: 100',
+    type=int, default=100)
+parser.add_argument('-o', '--out', help='Also write the results to this json file', default=None, metavar='[path]')
+args = parser.parse_args()
+
+repo = dirname(abspath(__file__))
+sys.path.insert(0, repo)
+
+# Share of the time unit each tool takes, and the files it writes into <subject>/mri
+STUBS = {
+    'segmentHA_T2.sh': (1.0, ['lh.hippoSfVolumes-T1-$3.v21.txt', 'rh.hippoSfVolumes-T1-$3.v21.txt',
+        'lh.hippoAmygLabels-T1-$3.v21.mgz', 'rh.hippoAmygLabels-T1-$3.v21.mgz'], '$5/$1/mri'),
+    'segmentThalamicNuclei.sh': (0.6, ['ThalamicNuclei.v13.T1.$4.volumes.txt', 'ThalamicNuclei.v13.T1.$4.mgz'], '$2/$1/mri'),
+    'segmentBS.sh': (0.3, ['brainstemSsVolumes.v13.txt', 'brainstemSsLabels.v13.mgz'], '$2/$1/mri'),
+}
+IMAGES = ['T1.mgz', 'norm.mgz', 'aseg.mgz', 'brainmask.mgz', 'orig.mgz', 'wm.mgz', 'aparc.a2009s+aseg.mgz']
+SURFACES = ['lh.white', 'rh.white', 'lh.pial', 'rh.pial', 'lh.inflated', 'rh.inflated', 'lh.thickness', 'rh.thickness']
+
+
+def mgh_header():
+    # MGH header of a float volume of --kb kB, seg's preflight reads it (see fstools.check_image)
+    header = bytearray(284)
+    struct.pack_into('>7ih', header, 0, 1, args.kb * 256, 1, 1, 1, 3, 0, 0)
+    return bytes(header)
+
+
+def nifti_header():
+    # NIfTI-1 header of a float32 volume of --kb kB, the data starts at 352
+    header = bytearray(352)
+    struct.pack_into('<i', header, 0, 348)
+    struct.pack_into('<8h', header, 40, 3, args.kb * 256, 1, 1, 1, 1, 1, 1)
+    struct.pack_into('<2h', header, 70, 16, 32)
+    struct.pack_into('<8f', header, 76, 1, 1, 1, 1, 1, 1, 1, 1)
+    struct.pack_into('<f', header, 108, 352)
+    header[344:348] = b'n+1\0'
+    return bytes(header)
+
+
+def burn_loop(seconds):
+    # sh snippet that sleeps and busy-loops for the given time, in the --burn proportion
+    cpu, idle = seconds * args.burn, seconds * (1 - args.burn)
+    return f'sleep {idle:.4f}\nend=$(( $(date +%s%N) + {int(cpu * 1e9)} ))\nwhile [ $(date +%s%N) -lt $end ]; do :; done\n'
+
+
+def write_stubs(bindir, tooldir):
+    # Stub tools, they take their share of the time unit and write outputs of the size of a real image
+    os.makedirs(bindir, exist_ok=True)
+    for name, (share, outputs, where) in STUBS.items():
+        body = '#!/bin/sh\n' + burn_loop(share * args.unit)
+        for o in outputs:
+            body += f'head -c {args.kb * 1024} /dev/zero > {where}/{o}\n'
+        with open(join(bindir, name), 'w') as f:
+            f.write(body)
+
+    # mri_sclimbic_seg --i T1 --o out ..., the toolbox setup.sh only has to put it on the PATH
+    body = '#!/bin/sh\n' + burn_loop(0.1 * args.unit)
+    body += f'head -c {args.kb * 1024} /dev/zero > $4\nstem=${{4%.mgz}}\necho "label,volume" > $stem.volumes.csv\necho "qa,1" > $stem.qa.csv\n'
+    with open(join(bindir, 'mri_sclimbic_seg'), 'w') as f:
+        f.write(body)
+
+    # recon-all -subjid sub -sd dir flags, rewrites a third of the images and the surfaces like a fix does,
+    # the images keep a valid MGH header
+    with open(join(bindir, 'mgh.hdr'), 'wb') as f:
+        f.write(mgh_header())
+    body = '#!/bin/sh\n' + burn_loop(2 * args.unit)
+    for img in IMAGES[::3]:
+        body += f'(cat {join(bindir, "mgh.hdr")}; head -c {args.kb * 1024} /dev/urandom) | gzip -1 > $4/$2/mri/{img}\n'
+    for surf in SURFACES[:4]:
+        body += f'head -c {args.kb * 1024} /dev/urandom > $4/$2/surf/{surf}\n'
+    with open(join(bindir, 'recon-all'), 'w') as f:
+        f.write(body)
+
+    for name in os.listdir(bindir):
+        if name != 'mgh.hdr':
+            os.chmod(join(bindir, name), 0o755)
+
+    os.makedirs(tooldir, exist_ok=True)
+    with open(join(tooldir, 'setup.sh'), 'w') as f:
+        f.write(f'export PATH={bindir}:$PATH\n')
+
+
+def make_cohort(root, n):
+    # FreeSurfer, hMRI, raw and dwi trees for n subjects, files are hardlinks to one blob so big cohorts stay cheap.
+    # The images are valid MGZ and NIfTI files, seg's preflight reads their headers.
+    fs = join(root, 'derivatives', 'freesurfer')
+    blob, mgz, nii = join(root, 'blob'), join(root, 'blob.mgz'), join(root, 'blob.nii')
+    if exists(join(root, 'ids.csv')):
+        return
+    os.makedirs(root, exist_ok=True)
+    data = os.urandom(args.kb * 1024)
+    with open(blob, 'wb') as f:
+        f.write(data)
+    with gzip.open(mgz, 'wb', compresslevel=1) as f:
+        f.write(mgh_header() + data)
+    with open(nii, 'wb') as f:
+        f.write(nifti_header() + data)
+
+    ids = []
+    for i in range(n):
+        sub = f'sub-{i:05d}'
+        ids.append(sub)
+        for d in ['mri', 'surf', 'label', 'scripts']:
+            os.makedirs(join(fs, sub, d))
+        for img in IMAGES:
+            os.link(mgz, join(fs, sub, 'mri', img))
+        for s in SURFACES:
+            os.link(blob, join(fs, sub, 'surf', s))
+        os.makedirs(join(root, 'derivatives', 'hmri', sub, 'Results'))
+        os.link(nii, join(root, 'derivatives', 'hmri', sub, 'Results', f'{sub}_PD.nii'))
+        os.makedirs(join(root, 'rawdata', sub, 'anat'))
+        os.makedirs(join(root, 'derivatives', 'dwi', sub))
+
+    with open(join(root, 'ids.csv'), 'w') as f:
+        f.write('ID\n' + '\n'.join(ids) + '\n')
+
+
+def measured(cmd, cwd, env, log=os.devnull):
+    # Runs cmd and returns wall time, peak RSS in MB and bytes read/written by it and its children
+    # (from /proc/<pid>/io of the process tree, e.g. the compressor fsra.py starts), the output goes to log
+    from fstools import tree_io
+
+    t0 = time.perf_counter()
+    with open(log, 'w') as out:
+        proc = sp.Popen(cmd, cwd=cwd, env=env, stdout=out)
+    io = {}
+    while True:
+        io = tree_io(proc.pid) or io
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            break
+        time.sleep(0.05)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return {'wall': time.perf_counter() - t0, 'rss_mb': usage.ru_maxrss / 1024, 'read': io.get('rchar', 0),
+        'written': io.get('wchar', 0), 'returncode': proc.returncode}
+
+
+def proc_io():
+    with open('/proc/self/io') as f:
+        return dict((k, int(v)) for k, v in (line.split(': ') for line in f))
+
+
+def bench_seg(root, n, env):
+    from fstools import seg
+
+    os.environ['PATH'] = env['PATH']
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        for f in ['bench_state.sqlite', 'bench_state.sqlite-wal', 'bench_state.sqlite-shm']:
+            if exists(f):
+                os.remove(f)
+        s = seg(subjects_dir=join(root, 'derivatives', 'freesurfer'), analysis_id='bench', pd_images_dir=join(root, 'derivatives', 'hmri'),
+            threads=args.threads, workers=args.workers, telegram=False, skip_existing=False,
+            hpc=True, thn=True, bss=True, scl=True, state_db=join(root, 'bench_state.sqlite'),
+            scratch_dir=join(root, 'scratch') if args.scratch else None)
+
+        t0 = time.perf_counter()
+        s.rebuild_state()
+        scan = time.perf_counter() - t0
+
+        io0 = proc_io()
+        t0 = time.perf_counter()
+        s.run_list(sorted(os.listdir(s.subjects_dir)))
+        wall = time.perf_counter() - t0
+        io1 = proc_io()
+    finally:
+        os.chdir(cwd)
+
+    # only the subjects that got every module done count
+    table = s.state.table()
+    done = sum(all(table[sub].get(m) == 'done' for m in s.enabled_modules()) for sub in table)
+    return {'wall': wall, 'scan': scan, 'read': io1['rchar'] - io0['rchar'], 'written': io1['wchar'] - io0['wchar'],
+        'rss_mb': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024,
+        'subjects': done}
+
+
+def bench_fsra(root, n, env):
+    n = min(n, args.fsraMax)
+    subs = sorted(os.listdir(join(root, 'derivatives', 'freesurfer')))[:n]
+    with open(join(root, 'fsra_batch.txt'), 'w') as f:
+        f.write('\n'.join(f'{s} cp' for s in subs) + '\n')
+    for f in ['fsra_queue.json']:
+        if exists(join(root, f)):
+            os.remove(join(root, f))
+    os.makedirs(join(root, 'backup'), exist_ok=True)
+    r = measured([sys.executable, join(repo, 'fsra.py'), '-B', 'fsra_batch.txt', '-sd', join(root, 'derivatives', 'freesurfer'),
+        '-td', join(root, 'tmp'), '-bd', join(root, 'backup')], root, env)
+    # the jobs the batch queue marked done
+    with open(join(root, 'fsra_queue.json')) as f:
+        r['subjects'] = sum(j['status'] == 'done' for j in json.load(f).values())
+    r['scan'] = None
+    return r
+
+
+def bench_datastock(root, n, env):
+    # a cold run without the cache and a warm one with it, each its own row
+    cmd = [sys.executable, join(repo, 'datastock.py'), '-i', 'ids.csv', '-o', 'stock.csv', '-p', root, '--deep']
+    rows = []
+    for run, extra in (('cold', ['--refresh']), ('warm', [])):
+        log = join(root, f'datastock_{run}.txt')
+        r = measured(cmd + extra, root, env, log=log)
+        # the scan time datastock.py reports itself, without the interpreter start-up and imports
+        with open(log) as f:
+            r['scan'] = float([line for line in f if line.startswith('Scanned')][-1].split(' in ')[1].split()[0])
+        # the subjects found in all the dirs
+        with open(join(root, 'stock.csv')) as f:
+            header = f.readline().strip().split(',')
+            found = [i for i, c in enumerate(header) if c in ('raw', 'hmri', 'freesurfer', 'dwi')]
+            r['subjects'] = sum(all(line.strip().split(',')[i] == 'True' for i in found) for line in f)
+        r['run'] = run
+        rows.append(r)
+    return rows
+
+
+if __name__ == '__main__':
+    root = abspath(args.dir)
+    bindir, tooldir = join(root, 'bin'), join(root, 'sclimbic')
+    write_stubs(bindir, tooldir)
+    env = dict(os.environ, PATH=f'{bindir}:{os.environ["PATH"]}')
+
+    benches = {'seg': bench_seg, 'fsra': bench_fsra, 'datastock': bench_datastock}
+    results = []
+    for n in args.sizes:
+        cohort = join(root, f'cohort_{n}')
+        print(f'Building a cohort of {n} subjects in {cohort}')
+        make_cohort(cohort, n)
+        # seg looks for the sclimbic toolbox in the working dir
+        if not exists(join(cohort, 'sclimbic')):
+            os.symlink(tooldir, join(cohort, 'sclimbic'))
+
+        for name in args.pipelines:
+            print(f'Running {name} on {n} subjects')
+            rows = benches[name](cohort, n, env)
+            for r in rows if isinstance(rows, list) else [rows]:
+                if r['subjects'] == 0:
+                    raise Exception(f'{name} did not finish any of the {n} subjects, see its output above')
+                r.update(pipeline=f'{name}/{r["run"]}' if 'run' in r else name, size=n, per_hour=r['subjects'] / r['wall'] * 3600)
+                results.append(r)
+
+    print(f'\n{"pipeline":<16}{"cohort":>8}{"subjects":>10}{"wall s":>10}{"subj/h":>12}{"scan s":>10}{"read MB":>10}{"written MB":>12}{"peak MB":>10}')
+    for r in results:
+        scan = f'{r["scan"]:.3f}' if r['scan'] is not None else '-'
+        print(f'{r["pipeline"]:<16}{r["size"]:>8}{r["subjects"]:>10}{r["wall"]:>10.2f}{r["per_hour"]:>12.0f}{scan:>10}'
+            f'{r["read"]/2**20:>10.1f}{r["written"]/2**20:>12.1f}{r["rss_mb"]:>10.1f}')
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
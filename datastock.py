@@ -1,38 +1,160 @@
 import argparse
+import os
+import time
 from os.path import exists, join
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+from fstools import check_image
 
 # Input args parser
 parser = argparse.ArgumentParser(description='Script for taking stock of the data. Inside there directories which should be looked into are listed.')
 parser.add_argument('-o', '--out', help='Output file. Defaults to data_stock.csv.', default='data_stock.csv')
 parser.add_argument('-i', '--ids', help='Input ID list file (default is valid_subjects.csv).', default='valid_subjects.csv')
+parser.add_argument('-d', '--deep', help='Also check that the files listed in `deep` are there for each subject found, \
+    and read the headers of the images listed in `images` to catch truncated or broken ones.', action='store_true', default=False)
+parser.add_argument('-w', '--workers', help='Parallel stat calls for the --deep check; default: 32', type=int, default=32)
+parser.add_argument('-p', '--prefix', help='Location of the dataset, the paths below are inside it; default: /mnt/nasips/COST_mri', default='/mnt/nasips/COST_mri')
+parser.add_argument('-c', '--cache', help='Inventory cache file, unchanged roots and subjects are not scanned again; default: datastock_cache.json', default='datastock_cache.json')
+parser.add_argument('-f', '--refresh', help='Ignore the cache and scan everything again.', action='store_true', default=False)
 parser.add_argument('-r', '--returns', help='Return all IDs or just those with something missing; default: all', default='all', choices=['all', 'missing', 'with_everything'])
 parser = parser.parse_args()
 
 # Paths to check
 paths = {
-    'raw': '/mnt/nasips/COST_mri/rawdata/',
-    'hmri':'/mnt/nasips/COST_mri/derivatives/hmri/',
-    'freesurfer': '/mnt/nasips/COST_mri/derivatives/freesurfer/',
-    'dwi': '/mnt/nasips/COST_mri/derivatives/dwi/'
+    'raw': join(parser.prefix, 'rawdata/'),
+    'hmri': join(parser.prefix, 'derivatives/hmri/'),
+    'freesurfer': join(parser.prefix, 'derivatives/freesurfer/'),
+    'dwi': join(parser.prefix, 'derivatives/dwi/')
 }
 
+# Files that should be in a subject's directory, checked with --deep
+deep = {
+    'raw': ['anat'],
+    'hmri': ['Results'],
+    'freesurfer': [join('mri', 'aseg.mgz'), join('surf', 'lh.pial'), join('surf', 'rh.pial')],
+    'dwi': []
+}
+
+# Images whose headers are checked with --deep, glob patterns inside a subject's directory
+images = {
+    'raw': [],
+    'hmri': [join('Results', '*PD.nii')],
+    'freesurfer': [join('mri', 'aseg.mgz'), join('mri', 'norm.mgz'), join('mri', 'T1.mgz')],
+    'dwi': []
+}
+
+
+def dir_key(path):
+    # mtime and link count (2 + number of subdirs) of a directory, these change when entries are added or removed
+    try:
+        st = os.stat(path)
+        return [st.st_mtime_ns, st.st_nlink]
+    except FileNotFoundError:
+        return None
+
+
+def listing(path, cache):
+    # Names of all the entries in path, a single scandir call per root, or none if the root did not change
+    key = dir_key(path)
+    if key is None:
+        print(f'{path} not found')
+        return set()
+    if cache.get('key') == key:
+        return set(cache['names'])
+    with os.scandir(path) as it:
+        names = set(e.name for e in it)
+    cache.update(key=key, names=sorted(names))
+    return names
+
+
+def complete(fqp, files, cache):
+    # True if all the files are in the subject's directory.
+    # The dirs holding the files are the cache key, the files are only checked again when one of them changed.
+    key = [dir_key(os.path.dirname(join(fqp, f))) for f in files]
+    if cache.get('key') == key:
+        return cache['ok']
+    ok = all(exists(join(fqp, f)) for f in files)
+    cache.update(key=key, ok=ok)
+    return ok
+
+
+def image_check(fqp, patterns, cache):
+    # 'ok' or the problems found in the headers of the subject's images.
+    # A file is only read again when its size or mtime changed.
+    problems = []
+    for pattern in patterns:
+        found = glob(join(fqp, pattern))
+        if len(found) == 0:
+            problems.append(f'{pattern}: missing')
+        for path in found:
+            st = os.stat(path)
+            rel = os.path.relpath(path, fqp)
+            entry = cache.get(rel)
+            if entry is None or entry[:2] != [st.st_size, st.st_mtime_ns]:
+                entry = cache[rel] = [st.st_size, st.st_mtime_ns, check_image(path)]
+            if entry[2]:
+                problems.append(f'{rel}: {entry[2]}')
+    return '; '.join(problems) if problems else 'ok'
+
+
+def load_cache(path):
+    import json
+    if parser.refresh or not exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_cache(path, cache):
+    # written to a temporary file first, so an interrupted run does not leave a broken cache
+    import json
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.replace(path + '.tmp', path)
+
+
 # Load the Ids for which we need to do the check
 df = pd.read_csv(parser.ids)
 ids = df.ID.values
 print(f'{len(ids)} valid subjects loaded from {parser.ids}')
 
-# Iterate all Ids
+subs = df.ID.astype(str).map(lambda s: s if 'sub-' in s else 'sub-'+s)
+cache = load_cache(parser.cache)
+t0 = time.perf_counter()
+
+# List each root once and check the Ids against it
 for d in paths.keys():
+    root = cache.setdefault(paths[d], {'subjects': {}})
     # Add the directory name to the df columns
-    df[d] = None
-    for i, sub in enumerate(ids):
-        if 'sub-' not in str(sub):
-            sub = 'sub-'+str(sub)
-        # Fully qualified path
-        fqp = join(paths[d], str(sub))
-        # directory should be there with a fqp
-        df.loc[i, d] = exists(fqp)
+    df[d] = subs.isin(listing(paths[d], root))
+
+    # The deeper checks need stat calls on the remote, run them concurrently for the subjects that are there
+    if parser.deep and deep[d]:
+        found = subs[df[d]]
+        with ThreadPoolExecutor(max_workers=parser.workers) as pool:
+            ok = list(pool.map(lambda sub: complete(join(paths[d], sub), deep[d], root['subjects'].setdefault(sub, {})), found))
+        df[f'{d}_complete'] = False
+        df.loc[found.index, f'{d}_complete'] = ok
+
+    # Header-only checks of the images, also in parallel
+    if parser.deep and images[d]:
+        found = subs[df[d]]
+        with ThreadPoolExecutor(max_workers=parser.workers) as pool:
+            checked = list(pool.map(lambda sub: image_check(join(paths[d], sub), images[d],
+                root['subjects'].setdefault(sub, {}).setdefault('images', {})), found))
+        df[f'{d}_images'] = ''
+        df.loc[found.index, f'{d}_images'] = checked
+        print(f'{d}: {sum(c != "ok" for c in checked)} of {len(found)} subjects have missing or broken images')
+
+save_cache(parser.cache, cache)
+print(f'Scanned {len(paths)} dirs for {len(subs)} subjects in {time.perf_counter() - t0:.3f} s')
+
+# The full table also goes to a columnar file next to the csv, for quick loading and filtering later
+try:
+    df.to_parquet(parser.out.split('.csv')[0]+'.parquet', index=False)
+except ImportError:
+    print('pyarrow or fastparquet is needed for the parquet output, only the csv is written.')
 
 if parser.returns == 'all':
     df.to_csv(parser.out, index=False)
@@ -0,0 +1,48 @@
+import argparse
+from os.path import join
+from datetime import datetime as dt
+from fstools import backupstore
+
+# Input args parser
+parser = argparse.ArgumentParser(description='Manage the deduplicating backup store written by fsra.py --store. \
+    Lists the snapshots, restores one of them, or removes snapshots and the files nothing refers to any more.')
+parser.add_argument('action', help='What to do', choices=['list', 'restore', 'remove', 'gc'])
+parser.add_argument('names', help='Snapshots to restore or remove, for list a prefix such as a subject ID', nargs='*')
+parser.add_argument('-bd', '--backupDir', help='The backup dir given to fsra.py, the store is in backupDir/store', metavar='[path]', \
+    default='/mnt/clab/COST_mri/derivatives/qa/fs')
+parser.add_argument('-o', '--out', help='Where to restore to, each snapshot goes to out/<subject>; default: restored/', \
+    metavar='[path]', default='restored')
+parser.add_argument('-w', '--workers', help='Files copied at the same time when restoring; default: 8', type=int, default=8)
+parser.add_argument('-k', '--keep', help='With remove and no names: keep the newest K snapshots of every subject, remove the rest', \
+    type=int, default=None)
+parser.add_argument('-n', '--dryRun', help='With gc: only report what would be removed', action='store_true', default=False)
+args = parser.parse_args()
+
+store = backupstore(join(args.backupDir, 'store'), workers=args.workers)
+
+if args.action == 'list':
+    for name in store.list(args.names[0] if args.names else ''):
+        m = store.manifest(name)
+        size = sum(e['size'] for e in m['files'].values())
+        print(f'{name}\t{dt.fromisoformat(m["time"]).strftime("%Y-%m-%d %H:%M")}\t{len(m["files"])} files\t{size/2**20:.1f} MB')
+
+elif args.action == 'restore':
+    for name in args.names:
+        # the snapshot names are <subject>_<timestamp>_<fix>
+        store.restore(name, join(args.out, name.split('_')[0]))
+
+elif args.action == 'remove':
+    names = args.names
+    if not names and args.keep is not None:
+        # the timestamp in the name sorts the snapshots of a subject in time
+        subjects = {}
+        for name in store.list():
+            subjects.setdefault(name.split('_')[0], []).append(name)
+        names = [n for snaps in subjects.values() for n in sorted(snaps)[:-args.keep or None]]
+    for name in names:
+        store.remove(name)
+        print(f'Removed snapshot {name}')
+    print('Run gc to free the space of the files only these snapshots used.')
+
+elif args.action == 'gc':
+    store.gc(dry_run=args.dryRun)
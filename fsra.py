@@ -4,9 +4,282 @@ from datetime import datetime as dt
 from os.path import join, exists
 import tarfile
 import time
+import shutil
+import threading
+import json
+import os
+from contextlib import contextmanager, nullcontext
+
+
+class TeeReader:
+    # File wrapper for tarfile, everything read from the source is also written to the local copy
+    def __init__(self, src, copy):
+        self.src = src
+        self.copy = copy
+
+    def read(self, size=-1):
+        data = self.src.read(size)
+        self.copy.write(data)
+        return data
+
+
+def compressor(archive, threads, method='auto'):
+    # Pick the fastest compressor available: zstd and pigz use all the threads, gzip is the fallback.
+    # Returns the archive name with the right extension and the command (None for python gzip)
+    if method in ('auto', 'zstd') and shutil.which('zstd'):
+        archive = f'{archive}.tar.zst'
+        return archive, ['zstd', '-q', '-f', '-3', f'-T{threads}', '-o', archive]
+    if method in ('auto', 'pigz') and shutil.which('pigz'):
+        archive = f'{archive}.tar.gz'
+        return archive, ['pigz', '-p', str(threads)]
+    return f'{archive}.tar.gz', None
+
+
+def backup(src, dst, archive, threads=4, method='auto'):
+    # Reads the subject from src once, writes the local working copy to dst and the compressed archive at the same time.
+    # archive is the name without extension, the one that was written is returned.
+    # Dangling links are skipped with a warning like cp -L does, if anything else fails the partial archive is removed.
+
+    if not exists(src):
+        raise Exception(f'{src} does not exist')
+
+    archive, cmd = compressor(archive, threads, method)
+    arcroot = os.path.normpath(dst).lstrip('/')
+
+    if cmd is None:
+        out, proc = None, None
+        tar = tarfile.open(archive, mode='w|gz')
+    else:
+        out = None if '-o' in cmd else open(archive, 'wb')
+        proc = sp.Popen(cmd, stdin=sp.PIPE, stdout=out)
+        tar = tarfile.open(fileobj=proc.stdin, mode='w|')
+    tar.dereference = True # same as cp -L
+
+    dangling = []
+    failed = False
+    try:
+        for root, dirs, files in os.walk(src, followlinks=True):
+            rel = os.path.relpath(root, src)
+            local = os.path.normpath(os.path.join(dst, rel))
+            os.makedirs(local, exist_ok=True)
+            tar.addfile(tar.gettarinfo(root, os.path.normpath(os.path.join(arcroot, rel))))
+            for f in files:
+                if not exists(os.path.join(root, f)):
+                    dangling.append(os.path.join(rel, f))
+                    continue
+                info = tar.gettarinfo(os.path.join(root, f), os.path.normpath(os.path.join(arcroot, rel, f)))
+                with open(os.path.join(root, f), 'rb') as fsrc, open(os.path.join(local, f), 'wb') as fcopy:
+                    tar.addfile(info, TeeReader(fsrc, fcopy))
+                shutil.copystat(os.path.join(root, f), os.path.join(local, f))
+            shutil.copystat(root, local)
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        # closing writes the end of the archive, which would make a partial one look complete
+        try:
+            tar.close()
+        finally:
+            if proc:
+                proc.stdin.close()
+                proc.wait()
+                if out:
+                    out.close()
+            if (failed or (proc and proc.returncode != 0)) and exists(archive):
+                os.remove(archive)
+
+    if proc and proc.returncode != 0:
+        raise Exception(f'{cmd[0]} failed with code {proc.returncode}')
+
+    if dangling:
+        print(f'Skipped {len(dangling)} dangling links in {src}: {" ".join(dangling)}')
+    return archive
+
+
+def file_hash(path):
+    # blake2b of the file content, read in 4 MB blocks
+    import hashlib
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(4 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def tree(path):
+    # {relative path: (size, mtime, is a link)} of all the files under path, links are followed and dangling ones skipped
+    files = {}
+    for root, _, names in os.walk(path, followlinks=True):
+        for f in names:
+            try:
+                st = os.stat(os.path.join(root, f))
+            except FileNotFoundError:
+                print(f'Skipping dangling link {os.path.join(root, f)}')
+                continue
+            files[os.path.relpath(os.path.join(root, f), path)] = (st.st_size, st.st_mtime, os.path.islink(os.path.join(root, f)))
+    return files
+
+
+def exchange(a, b):
+    # Swaps two paths with renameat2(RENAME_EXCHANGE) in one step, False where the kernel or filesystem cannot
+    import ctypes
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.renameat2(-100, os.fsencode(a), -100, os.fsencode(b), 2) == 0
+    except (AttributeError, OSError):
+        return False
+
+
+def sync(src, dst, workers=8, use_hash=False):
+    # Makes dst the same as src transferring only the new or changed files (size/mtime, or content with use_hash).
+    # The new tree is built next to dst (.<name>.fsra-new) with hard links to the unchanged files and copies of
+    # the changed ones, then swapped in, so readers see either the old or the new subject and never a mix.
+    # The swap is atomic where renameat2 exchange works, otherwise it is two renames and dst is missing for an instant.
+    # Shares without hard links fall back to replacing the files in place, then only each single file is atomic.
+    # Returns the number of files copied, removed and the bytes copied.
+    from concurrent.futures import ThreadPoolExecutor
+
+    local, remote = tree(src), tree(dst) if exists(dst) else {}
+
+    def changed(rel):
+        if rel not in remote or remote[rel][0] != local[rel][0] or remote[rel][2] != local[rel][2]:
+            # links are replaced by the file, their target may go away
+            return True
+        if abs(remote[rel][1] - local[rel][1]) <= 1: # some shares only keep whole seconds
+            return False
+        return file_hash(join(src, rel)) != file_hash(join(dst, rel)) if use_hash else True
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        todo = [rel for rel, c in zip(local, pool.map(changed, local)) if c]
+    keep = [rel for rel in local if rel not in todo]
+    stale = [rel for rel in remote if rel not in local]
+
+    # the new tree, with all the dirs of src
+    parent, name = os.path.split(os.path.normpath(dst))
+    new, old = join(parent, f'.{name}.fsra-new'), join(parent, f'.{name}.fsra-old')
+    for d in (new, old):
+        if exists(d):
+            shutil.rmtree(d)
+    for root, _, _ in os.walk(src, followlinks=True):
+        os.makedirs(join(new, os.path.relpath(root, src)), exist_ok=True)
+        shutil.copymode(root, join(new, os.path.relpath(root, src)))
+
+    try:
+        for rel in keep:
+            os.link(join(dst, rel), join(new, rel))
+        target = new
+    except OSError as e:
+        print(f'No hard links next to {dst} ({e}), syncing it file by file')
+        shutil.rmtree(new)
+        target = dst
+
+    def copy(rel):
+        path = join(target, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copy2(join(src, rel), path + '.fsra-part')
+        os.replace(path + '.fsra-part', path)
+        return local[rel][0]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        copied = sum(pool.map(copy, todo))
+
+    if target == new:
+        if not exists(dst):
+            os.rename(new, dst)
+        elif exchange(new, dst):
+            shutil.rmtree(new)
+        else:
+            os.rename(dst, old)
+            os.rename(new, dst)
+            shutil.rmtree(old)
+        return len(todo), len(stale), copied
+
+    # in place: stale files are removed last, so dst is never missing anything that is still there in src
+    for rel in stale:
+        os.remove(join(dst, rel))
+    # and the dirs that are gone locally
+    for root, dirs, _ in os.walk(dst, topdown=False):
+        rel = os.path.relpath(root, dst)
+        if rel != '.' and not os.path.isdir(join(src, rel)) and not os.listdir(root):
+            os.rmdir(root)
+
+    return len(todo), len(stale), copied
+
+# recon-all flags for each fix, run one after another
+RECON = {
+    'cp': ['-autorecon2-cp -autorecon3'],
+    'wm': ['-autorecon2-wm -autorecon3'],
+    'gm': ['-autorecon-pial'],
+    'wgm': ['-autorecon2-wm -autorecon3', '-autorecon-pial'],
+}
+
+
+class Queue:
+    # Persistent queue for the batch mode, a json file that is rewritten atomically after every change,
+    # so a restarted batch knows which stages of which jobs are finished already.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.jobs = {}
+        if exists(path):
+            with open(path) as f:
+                self.jobs = json.load(f)
+
+    def add(self, sub, fix):
+        key = f'{sub}_{fix}'
+        with self.lock:
+            if key not in self.jobs:
+                self.jobs[key] = {'sub': sub, 'fix': fix, 'status': 'queued', 'stages': [], 'zfile': None}
+            self.save()
+        return key
+
+    def update(self, key, stage=None, **kw):
+        with self.lock:
+            if stage:
+                self.jobs[key]['stages'].append(stage)
+            self.jobs[key].update(kw)
+            self.save()
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.jobs, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class Resources:
+    # Admission control for the batch mode. A stage waits until what it asks for (cores, ram in GB, scratch in GB)
+    # is free. A request bigger than the machine goes through once nothing else holds that resource.
+    def __init__(self, **total):
+        self.total = total
+        self.free = dict(total)
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def hold(self, **need):
+        with self.cond:
+            self.cond.wait_for(lambda: all(self.free[k] >= v or self.free[k] == self.total[k] for k, v in need.items()))
+            for k, v in need.items():
+                self.free[k] -= v
+        try:
+            yield
+        finally:
+            with self.cond:
+                for k, v in need.items():
+                    self.free[k] += v
+                self.cond.notify_all()
+
+
+def mem_available():
+    # MemAvailable from /proc/meminfo in GB
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable'):
+                return int(line.split()[1]) / 2**20
+    return 0
+
 
 args=argparse.ArgumentParser(description='This function helps with the reprocessing with recon-all.')
-args.add_argument('sub', help='The subject ID')
+args.add_argument('sub', help='The subject ID, not needed with --batch', nargs='?')
 args.add_argument('-f', '--fix', help='The fix to run; either cp, wm, gm or wgm (white then gray matter)', choices=['cp', 'wm', 'gm', 'wgm'], default='wgm')
 args.add_argument('-w', '--wait', help='wait for X minutes before starting this job', type=int, default=0, metavar='minutes')
 args.add_argument('-sd', '--subjectsDir', help='The directory where the subjects are stored. Remote drive is ok.', metavar='[path]',\
@@ -16,89 +289,210 @@ args.add_argument('-td', '--tmpdir', help='The directory where the temporary fil
 args.add_argument('-bd', '--backupDir', help='The directory where the backup files are stored. Remote drive is ok.', metavar='[path]',\
     default='/mnt/clab/COST_mri/derivatives/qa/fs', required=False)
 args.add_argument('-t', '--telegram', help='Send telegram messages', required=False, default=True, action='store_true')
+args.add_argument('-j', '--threads', help='Threads for compressing the backup', type=int, default=8, required=False)
+args.add_argument('-z', '--compressor', help='Compressor for the backup, auto picks zstd, then pigz, then gzip', \
+    choices=['auto', 'zstd', 'pigz', 'gzip'], default='auto', required=False)
+args.add_argument('-sw', '--syncWorkers', help='Parallel copies when syncing the results back', type=int, default=8, required=False)
+args.add_argument('-H', '--hash', help='Compare file contents (blake2b) when size matches but mtime differs, instead of copying', \
+    required=False, default=False, action='store_true')
+args.add_argument('-bg', '--background', help='Write the archive to tmpdir and move it to backupDir in the background while recon-all runs', \
+    required=False, default=False, action='store_true')
+args.add_argument('-S', '--store', help='Back up into a deduplicating store in backupDir/store instead of an archive per run, \
+    only the files that changed since an earlier backup are written; see fsbackup.py for restore and gc', \
+    required=False, default=False, action='store_true')
+args.add_argument('-B', '--batch', help='File with one subject and (optionally) fix per line, runs them all through a persistent queue', \
+    metavar='[path]', required=False, default=None)
+args.add_argument('-q', '--queue', help='The queue state file for --batch, rerun with the same file to resume', metavar='[path]', \
+    default='fsra_queue.json', required=False)
+args.add_argument('-jc', '--jobCores', help='Cores reserved for each recon-all job in --batch', type=float, default=1, required=False)
+args.add_argument('-jr', '--jobRam', help='RAM in GB reserved for each recon-all job in --batch', type=float, default=4, required=False)
+args.add_argument('-io', '--ioJobs', help='How many backup/sync stages can run at the same time in --batch', type=int, default=2, required=False)
 args = args.parse_args()
 
+if not args.batch and not args.sub:
+    print('Either a subject ID or --batch is needed.')
+    exit(1)
 
-if not args.sub.startswith('sub-'):
-        args.sub = f'sub-{args.sub}'
+store = None
+if args.store:
+    from fstools import backupstore
+    store = backupstore(join(args.backupDir, 'store'), workers=args.syncWorkers)
 
 if not exists('telegram.py'):
     print('Telegram module not found, messages will not be sent.')
     args.telegram = False
 
-# wait for X minutes before starting this job
-if args.wait > 0:
-    print(f'Waiting for {args.wait} minutes before starting the job.')
-    time.sleep(args.wait * 60)
 
-# cp to local
-try:
-    sp.run(f'cp -RL {join(args.subjectsDir, args.sub)} {args.tmpdir}', shell=True)
-    # backup the subject data on nasips
-    d2zip = join(args.tmpdir, args.sub)
-    zfile = join(args.backupDir, f'{args.sub}_{dt.now().strftime("%Y%m%d%H%M%S")}_{args.fix}.tar.gz')
-    print(f'Compressing and moving {args.sub} data to {zfile}')
-    tar = tarfile.open(zfile, mode="w:gz")
-    tar.add(d2zip)
-    tar.close()
-except Exception as e:
+def notify(msg):
     if args.telegram:
-        sp.run(f'python telegram.py -m "Error recon-all for {args.sub} {args.fix}: could not copy or compress files for backup: {e}"', shell=True)
-    print(e)
-    print('Something went wrong with the copy to local or tar compression.')
-    exit(1)
+        sp.run(f'python telegram.py -m "{msg}"', shell=True)
 
-#if args.telegram:
-    #sp.run(f'python telegram.py -m "Started recon-all for {args.sub} {args.fix}"', shell=True)
 
-# run recon-all
-try:
-    if args.fix == 'cp':
-        sp.run(f'recon-all -subjid {args.sub} -sd {args.tmpdir} -autorecon2-cp -autorecon3', shell=True)
-    elif args.fix == 'wm':
-        sp.run(f'recon-all -subjid {args.sub} -sd {args.tmpdir} -autorecon2-wm -autorecon3', shell=True)
-    elif args.fix == 'gm':
-        sp.run(f'recon-all -subjid {args.sub} -sd {args.tmpdir} -autorecon-pial', shell=True)
-    elif args.fix == 'wgm':
-        sp.run(f'recon-all -subjid {args.sub} -sd {args.tmpdir} -autorecon2-wm -autorecon3', shell=True)
-        sp.run(f'recon-all -subjid {args.sub} -sd {args.tmpdir} -autorecon-pial', shell=True)
-except Exception as e:
-    if args.telegram:
-        sp.run(f'python telegram.py -m "Error recon-all for {args.sub} {args.fix}: recon all failed: {e}"', shell=True)
-    print(e)
-    print('Something went wrong with the recon-all command.')
-    exit(1)
-    
-# rm old on nasips
-try:
-    sp.run(f'rm -rf {join(args.subjectsDir, args.sub)}', shell=True)
-except Exception as e:
-    if args.telegram:
-        sp.run(f'python telegram.py -m "Error recon-all for {args.sub} {args.fix}: could not remove old files from nasips: {e}"', shell=True)
-    print(e)
-    print('Something went wrong with the remove old files command.')
-    exit(1)
+def run_job(sub, fix, done=(), mark=lambda stage, **kw: None, zfile=None, gate=lambda stage: nullcontext()):
+    # Runs one fix for one subject: backup, recon, sync and cleanup.
+    # Stages listed in done are skipped and mark is called after each stage, so the batch queue can resume from there.
+    # gate(stage) gives the context that holds the resources a stage needs.
+    d2zip = join(args.tmpdir, sub)
+    mover = None
 
-# cp to nasips
-try:
-    sp.run(f'cp -RL {join(args.tmpdir, args.sub)} {args.subjectsDir}', shell=True)
-except Exception as e:
-    if args.telegram:
-        sp.run(f'python telegram.py -m "Error recon-all for {args.sub} {args.fix}: could not copy files to nasips: {e}"', shell=True)
-    print(e)
-    print('Something went wrong with the copy to nasips command.')
-    exit(1)
+    # a restart after the local copy was lost has to begin from the backup again
+    if 'recon' not in done and not exists(d2zip):
+        done = ()
+    if 'sync' not in done and 'recon' in done and not exists(d2zip):
+        raise Exception(f'Local copy {d2zip} is gone, the recon-all results for {sub} {fix} are lost')
+
+    # cp to local and backup the subject data on nasips, in one pass over the remote data
+    if 'backup' not in done:
+        try:
+            with gate('backup'):
+                zname = f'{sub}_{dt.now().strftime("%Y%m%d%H%M%S")}_{fix}'
+                if store:
+                    # the snapshot only writes the files the store does not have yet
+                    print(f'Copying {sub} to {d2zip} and storing snapshot {zname} in {store.root}')
+                    zfile = store.snapshot(join(args.subjectsDir, sub), zname, copy_to=d2zip)
+                else:
+                    zfile = join(args.tmpdir if args.background else args.backupDir, zname)
+                    print(f'Copying {sub} to {d2zip} and compressing to {zfile}')
+                    zfile = backup(join(args.subjectsDir, sub), d2zip, zfile, args.threads, args.compressor)
+
+            # move the archive to the backup dir while recon-all is running
+            if args.background and not store:
+                mover = threading.Thread(target=shutil.move, args=(zfile, args.backupDir))
+                mover.start()
+        except Exception as e:
+            notify(f'Error recon-all for {sub} {fix}: could not copy or compress files for backup: {e}')
+            print(e)
+            print('Something went wrong with the copy to local or tar compression.')
+            raise
+        mark('backup', zfile=zfile)
+
+    #notify(f'Started recon-all for {sub} {fix}')
+
+    # run recon-all
+    if 'recon' not in done:
+        try:
+            with gate('recon'):
+                for flags in RECON[fix]:
+                    sp.run(f'recon-all -subjid {sub} -sd {args.tmpdir} {flags}', shell=True, check=True)
+        except Exception as e:
+            notify(f'Error recon-all for {sub} {fix}: recon all failed: {e}')
+            print(e)
+            print('Something went wrong with the recon-all command.')
+            raise
+        mark('recon')
+
+    # the backup has to be safe before the old files are removed
+    if mover:
+        mover.join()
+    if args.background and not store and zfile and exists(zfile) and os.path.dirname(zfile) == os.path.normpath(args.tmpdir):
+        # the background move failed, or the batch was restarted before it happened
+        try:
+            shutil.move(zfile, args.backupDir)
+        except Exception as e:
+            notify(f'Error recon-all for {sub} {fix}: could not move the backup to {args.backupDir}')
+            print(f'Backup {zfile} was not moved to {args.backupDir}, leaving the remote data as it is.')
+            raise
+
+    # sync the changes back to nasips
+    if 'sync' not in done:
+        try:
+            with gate('sync'):
+                ncopied, nremoved, nbytes = sync(d2zip, join(args.subjectsDir, sub), args.syncWorkers, args.hash)
+            print(f'Synced {sub}: {ncopied} files copied ({nbytes/2**20:.1f} MB), {nremoved} stale files removed.')
+        except Exception as e:
+            notify(f'Error recon-all for {sub} {fix}: could not sync files to nasips: {e}')
+            print(e)
+            print('Something went wrong with the sync to nasips.')
+            raise
+        mark('sync')
+
+    # rm local
+    try:
+        sp.run(f'rm -rf {d2zip}', shell=True)
+    except Exception as e:
+        notify(f'Error recon-all for {sub} {fix}: could not remove local files: {e}')
+        print(e)
+        print('Something went wrong with the remove local files command.')
+        raise
+    mark('cleanup')
+
+
+def run_batch():
+    # Runs all the jobs from the batch file through the persistent queue.
+    # Jobs of the same subject run in order, one after another. Different subjects run at the same time:
+    # recon-all only starts when cores and RAM are free, at most ioJobs backups/syncs copy at once,
+    # and a subject's scratch space is reserved from its backup to its cleanup.
+    from concurrent.futures import ThreadPoolExecutor
+
+    queue = Queue(args.queue)
+    with open(args.batch) as f:
+        for line in f:
+            parts = line.replace(',', ' ').split()
+            if len(parts) == 0 or parts[0].startswith('#'):
+                continue
+            sub = parts[0] if parts[0].startswith('sub-') else f'sub-{parts[0]}'
+            queue.add(sub, parts[1] if len(parts) > 1 else args.fix)
+
+    todo = {}
+    for key, job in queue.jobs.items():
+        if job['status'] != 'done':
+            todo.setdefault(job['sub'], []).append(key)
+    print(f'{sum(len(k) for k in todo.values())} jobs for {len(todo)} subjects in the queue.')
+
+    os.makedirs(args.tmpdir, exist_ok=True)
+    res = Resources(cores=os.cpu_count(), ram=mem_available(), scratch=shutil.disk_usage(args.tmpdir).free / 2**30)
+    io = threading.Semaphore(args.ioJobs)
+    print(f'Resources: {res.total["cores"]} cores, {res.total["ram"]:.1f} GB RAM, {res.total["scratch"]:.1f} GB scratch.')
+
+    def gate(stage):
+        if stage == 'recon':
+            return res.hold(cores=args.jobCores, ram=args.jobRam)
+        return io
+
+    def run_subject(sub):
+        # recon-all grows the subject, keep half as much again free on the scratch disk.
+        # Sizing walks the subject on the NAS, it waits for a free io slot like the copies do.
+        src = join(args.subjectsDir, sub)
+        with io:
+            need = 1.5 * sum(v[0] for v in tree(src).values()) / 2**30 if exists(src) else 0
+        with res.hold(scratch=need):
+            for key in todo[sub]:
+                job = queue.jobs[key]
+                queue.update(key, status='running')
+                try:
+                    run_job(sub, job['fix'], job['stages'], lambda stage, **kw: queue.update(key, stage, **kw), job['zfile'], gate)
+                except Exception as e:
+                    queue.update(key, status='failed', error=str(e))
+                    print(f'{key} failed, the next jobs of {sub} are not run.')
+                    return
+                queue.update(key, status='done')
+                notify(f'Done recon-all for {sub} {job["fix"]}')
+
+    # subjects beyond this wait for a free thread, their jobs would only wait for resources anyway
+    with ThreadPoolExecutor(max_workers=max(1, min(len(todo), 4 * os.cpu_count()))) as pool:
+        list(pool.map(run_subject, todo))
+
+    failed = [k for k, j in queue.jobs.items() if j['status'] != 'done']
+    print(f'Batch finished, {len(queue.jobs) - len(failed)} jobs done, {len(failed)} not done: {" ".join(failed)}')
+    notify(f'Batch recon-all finished, {len(failed)} jobs not done')
+
+
+if args.batch:
+    run_batch()
+    exit(0)
+
+if not args.sub.startswith('sub-'):
+        args.sub = f'sub-{args.sub}'
+
+# wait for X minutes before starting this job
+if args.wait > 0:
+    print(f'Waiting for {args.wait} minutes before starting the job.')
+    time.sleep(args.wait * 60)
 
-# rm local
 try:
-    sp.run(f'rm -rf {join(args.tmpdir, args.sub)}', shell=True)
-except Exception as e:
-    if args.telegram:
-        sp.run(f'python telegram.py -m "Error recon-all for {args.sub} {args.fix}: could not remove local files: {e}"', shell=True)
-    print(e)
-    print('Something went wrong with the remove local files command.')
+    run_job(args.sub, args.fix)
+except Exception:
     exit(1)
 
 # send telegram message
-if args.telegram:
-    sp.run(f'python telegram.py -m "Done recon-all for {args.sub} {args.fix}"', shell=True)
+notify(f'Done recon-all for {args.sub} {args.fix}')
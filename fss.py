@@ -2,12 +2,14 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import os
+import json
 from os.path import join, exists
 import subprocess as sb
 
 parser = argparse.ArgumentParser(description = 'This is a script to help with plotting of freesurfer outputs, pass subject id and the it will take care of plotting for you. Optionally you can add an argument to show the 3d render of the brain as infalted. @author: aleksander nitka')
 
-parser.add_argument('id', help = 'Subject id, must be specified as first argument')
+parser.add_argument('id', help = 'Subject id, must be specified as first argument (not needed with --batch)', nargs = '?')
 parser.add_argument('-i', '--inflated', help = 'Show the inflated surface, no aseg, just pial surface', action = 'store_true', required = False, default = False)
 parser.add_argument('-a', '--aparc', help = 'Load default with aparc aseg', action = 'store_true', required = False, default = False)
 parser.add_argument('-r', '--ras', help = 'Go to given RAS coordinate x y z', required = False, nargs=3, metavar=('x', 'y', 'z'), type = float)
@@ -16,48 +18,85 @@ parser.add_argument('-m', '--machine', help = 'Specify mechine, default is krake
 parser.add_argument('-l', '--linew', help = 'Specify line width for the Pial/WM plotting, default is 1', required=False, default=1)
 parser.add_argument('-p', '--path', help = 'Specify full path the data folder, this will ignore the --machine flag', required=False, default=False)
 parser.add_argument('-b', '--backup', help = 'Specify the path for backup files, this is for the --comapre mode with --path specified', required = False, default = False)
+parser.add_argument('-L', '--list', help = 'File with a subject id per line, opens them one after another for review (next one opens when freeview is closed)', required = False, default = False)
+parser.add_argument('-C', '--cache', help = 'Local dir to cache the files in, freeview reads them from there and the next subjects of --list are prefetched', required = False, default = False)
+parser.add_argument('-s', '--cacheSize', help = 'Size of the --cache in GB, least recently used files are removed, default is 20', required = False, default = 20, type = float)
+parser.add_argument('-n', '--ahead', help = 'How many of the next subjects in --list to prefetch into the --cache, default is 2', required = False, default = 2, type = int)
+parser.add_argument('-B', '--batch', help = 'File with a subject id per line, saves a screenshot of the chosen view for each of them headlessly', required = False, default = False)
+parser.add_argument('-o', '--outdir', help = 'Where the --batch screenshots go, default is snapshots', required = False, default = 'snapshots')
+parser.add_argument('-j', '--jobs', help = 'How many freeview instances render at the same time in --batch, default is 4', required = False, default = 4, type = int)
+parser.add_argument('-f', '--force', help = 'Render all the --batch screenshots again, even when the inputs did not change', required = False, default = False, action = 'store_true')
 args = parser.parse_args()
 
-sub = args.id
-if 'sub-' not in sub:
-    sub = 'sub-' + sub
+if not args.id and not args.batch and not args.list:
+    print('Error: a subject id, --list or --batch is needed')
+    exit(1)
 
-if not args.path:
+# the view preset, from the flags
+if args.aparc:
+    preset = 'aparc'
+elif args.inflated:
+    preset = 'inflated'
+elif args.compare:
+    preset = 'compare'
+else:
+    preset = 'default'
+
+
+def subject_dirs(sub):
+    # Returns the subject dir and the backup dir (for --compare) of a subject
+    if not args.path:
+
+        if args.machine == 'kpc':
+            mnt = '/mnt/clab/'
+        elif args.machine == 'kraken':
+            mnt = '/mnt/nasips/'
+        else:
+            print(f'Error: {args.machine} is not recognised, please use kraken or kpc')
+            exit(1)
+
+        ssbck = join(mnt, 'aleksander', 'FreeSurfer_20220527', sub)
+        ssdir = join(mnt, 'COST_mri', 'derivatives', 'freesurfer', sub)
 
-    if args.machine == 'kpc':
-        mnt = '/mnt/clab/'
-    elif args.machine == 'kraken':
-        mnt = '/mnt/nasips/'
     else:
-        print(f'Error: {parser.machine} is not recognised, please use kraken or kpc')
-        exit(1)
+        if args.backup:
+            ssbck = join(args.backup, sub)
+        else:
+            ssbck = join(args.path, sub)
+        ssdir = join(args.path, sub)
 
-    ssbck = join(mnt, 'aleksander', 'FreeSurfer_20220527', sub)
-    ssdir = join(mnt, 'COST_mri', 'derivatives', 'freesurfer', sub)
-    
-else:
-    if args.backup:
-        ssbck = join(args.backup, sub)
-    else:    
-        ssbck = join(args.path, sub)
-    ssdir = join(args.path, sub)
-if exists(ssdir) == False:
-    print(f'Error: {ssdir} does not exist!')
-        
-else:
+    return ssdir, ssbck
+
+
+def preset_files(ssdir, ssbck):
+    # All the files freeview reads for the preset, the surface overlays and annotations included
+    if preset == 'aparc':
+        return [join(ssdir, 'mri', f) for f in ['brainmask.mgz', 'wm.mgz', 'aparc.a2009s+aseg.mgz']] + \
+            [join(ssdir, 'surf', f'{h}.{s}') for h in ['lh', 'rh'] for s in ['pial', 'white']] + \
+            [join(ssdir, 'label', f'{h}.aparc.a2009s.annot') for h in ['lh', 'rh']]
+    if preset == 'inflated':
+        return [join(ssdir, 'surf', f'{h}.{s}') for h in ['lh', 'rh'] for s in ['inflated', 'thickness']]
+    if preset == 'compare':
+        return [join(ssdir, 'mri', 'brainmask.mgz')] + \
+            [join(d, 'surf', f'{h}.{s}') for d in [ssdir, ssbck] for h in ['lh', 'rh'] for s in ['pial', 'white']]
+    return [join(ssdir, 'mri', f) for f in ['brainmask.mgz', 'orig.mgz', 'wm.mgz']] + \
+        [join(ssdir, 'surf', f'{h}.{s}') for h in ['lh', 'rh'] for s in ['pial', 'white']]
+
+
+def view_cmd(ssdir, ssbck):
     # Build the cmd
     st1 = join(ssdir, 'mri', 'brainmask.mgz')
     st2 = join(ssdir, 'mri', 'orig.mgz')
     wmm = join(ssdir, 'mri', 'wm.mgz')
 
-    if args.aparc:
+    if preset == 'aparc':
         a09 = join(ssdir, 'mri', 'aparc.a2009s+aseg.mgz')
         lhp = join(ssdir, 'surf', 'lh.pial')
         rhp = join(ssdir, 'surf', 'rh.pial')
         lhw = join(ssdir, 'surf', 'lh.white')
         rhw = join(ssdir, 'surf', 'rh.white')
         annots = 'aparc.a2009s.annot'
-        
+
         cmd = f'freeview -v {st1} -v {wmm}:colormap=heat:opacity=0.8:heatscale=1,110 -v {a09}:colormap=LUT:opacity=0.3 \
                 -f {lhp}:edgecolor=blue:annot={annots}:edgethickness={args.linew} \
                 -f {rhp}:edgecolor=blue:annot={annots}:edgethickness={args.linew} \
@@ -65,13 +104,13 @@ else:
                 -f {rhw}:edgecolor=yellow:edgethickness={args.linew}'
 
 
-    elif args.inflated:
+    elif preset == 'inflated':
         lhp = join(ssdir, 'surf', 'lh.inflated')
         rhp = join(ssdir, 'surf', 'rh.inflated')
         cmd = f'freeview -f {lhp}:overlay=lh.thickness:visible=1:overlay_threshold=0,5\
                 -f {rhp}:overlay=rh.thickness:visible=1:overlay_threshold=0,5 -layout 1 -view lateral -viewport 3d'
 
-    elif args.compare:
+    elif preset == 'compare':
         # This assumes that NEW is the fixed volume and OLD is in backup folder
         lhpN = join(ssdir, 'surf', 'lh.pial')
         rhpN = join(ssdir, 'surf', 'rh.pial')
@@ -98,7 +137,7 @@ else:
         rhp = join(ssdir, 'surf', 'rh.pial')
         lhw = join(ssdir, 'surf', 'lh.white')
         rhw = join(ssdir, 'surf', 'rh.white')
-        
+
         cmd = f'freeview -v {st1} -v {st2}:opacity=0.3:visible=0 -v {wmm}:colormap=heat:opacity=0.8:heatscale=1,110 \
                 -f {lhp}:edgecolor=blue:edgethickness={args.linew}:curvature_method=off \
                 -f {rhp}:edgecolor=blue:edgethickness={args.linew}:curvature_method=off \
@@ -106,6 +145,124 @@ else:
                 -f {rhw}:edgecolor=yellow:edgethickness={args.linew} -viewport coronal -layout 4'
 
     if args.ras:
-        cmd = cmd + f' -ras {args.ras[0]} {args.ras[1]} {args.ras[2]}' 
-    
-    sb.run(cmd, shell=True)
+        cmd = cmd + f' -ras {args.ras[0]} {args.ras[1]} {args.ras[2]}'
+
+    return cmd
+
+
+def signature(files):
+    # size and mtime of the inputs, the screenshot is out of date when any of them changed
+    sig = []
+    for f in files:
+        try:
+            st = os.stat(f)
+            sig.append([f, st.st_size, st.st_mtime_ns])
+        except FileNotFoundError:
+            sig.append([f, None, None])
+    return sig
+
+
+def snapshot(sub):
+    # Renders the screenshot of one subject headlessly, returns (sub, status, signature)
+    ssdir, ssbck = subject_dirs(sub)
+    if not exists(ssdir):
+        return sub, f'{ssdir} does not exist', None
+
+    png = join(args.outdir, f'{sub}_{preset}.png')
+    sig = signature(preset_files(ssdir, ssbck))
+    if not args.force and exists(png) and done.get(f'{sub}_{preset}') == sig:
+        return sub, 'unchanged', sig
+
+    # freeview draws into a virtual X display, takes the screenshot and quits
+    cmd = f'xvfb-run -a -s "-screen 0 1600x1200x24" {view_cmd(ssdir, ssbck)} -ss {png} -quit'
+    result = sb.run(cmd, shell=True, capture_output=True)
+    if result.returncode != 0 or not exists(png):
+        return sub, f'freeview failed: {result.stderr.decode("utf-8", "replace")[-500:]}', None
+    return sub, 'rendered', sig
+
+
+if args.batch:
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    os.makedirs(args.outdir, exist_ok=True)
+    with open(args.batch) as f:
+        subs = [s.strip() for s in f if s.strip()]
+    subs = [s if 'sub-' in s else 'sub-' + s for s in subs]
+
+    # what was rendered before and from which inputs
+    manifest = join(args.outdir, 'snapshots.json')
+    done = {}
+    if exists(manifest):
+        with open(manifest) as f:
+            done = json.load(f)
+
+    def save_manifest():
+        with open(manifest + '.tmp', 'w') as f:
+            json.dump(done, f)
+        os.replace(manifest + '.tmp', manifest)
+
+    # every job is its own freeview process, the pool only caps how many run at once.
+    # The manifest is saved after every new screenshot, an interrupted batch does not render them again.
+    counts = {}
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        try:
+            for job in as_completed([pool.submit(snapshot, s) for s in subs]):
+                sub, status, sig = job.result()
+                if sig:
+                    done[f'{sub}_{preset}'] = sig
+                    if status == 'rendered':
+                        save_manifest()
+                else:
+                    print(f'{sub}: {status}')
+                counts[status if sig else 'failed'] = counts.get(status if sig else 'failed', 0) + 1
+        finally:
+            save_manifest()
+
+    print(', '.join(f'{n} {k}' for k, n in counts.items()) + f', screenshots in {args.outdir}')
+    exit(0)
+
+def cached_dirs(sub):
+    # Pulls the files of the preset into the cache and returns the cached subject and backup dirs
+    ssdir, ssbck = subject_dirs(sub)
+    for f in preset_files(ssdir, ssbck):
+        try:
+            cache.get(f)
+        except FileNotFoundError:
+            pass # freeview will say what is missing
+    return cache.local(ssdir), cache.local(ssbck)
+
+
+def prefetch(subs):
+    # Starts copying the files the preset needs for these subjects
+    for s in subs:
+        ssdir, ssbck = subject_dirs(s)
+        if exists(ssdir):
+            cache.prefetch([f for f in preset_files(ssdir, ssbck) if exists(f)])
+
+
+cache = None
+if args.cache:
+    from fstools import filecache
+    cache = filecache(args.cache, max_bytes=int(args.cacheSize * 2**30))
+
+if args.list:
+    with open(args.list) as f:
+        subs = [s.strip() for s in f if s.strip()]
+else:
+    subs = [args.id]
+subs = [s if 'sub-' in s else 'sub-' + s for s in subs]
+
+for i, sub in enumerate(subs):
+    ssdir, ssbck = subject_dirs(sub)
+    if exists(ssdir) == False:
+        print(f'Error: {ssdir} does not exist!')
+        continue
+
+    if cache:
+        ssdir, ssbck = cached_dirs(sub)
+        # the next ones are copied while this one is being looked at
+        prefetch(subs[i+1:i+1+args.ahead])
+
+    if len(subs) > 1:
+        print(f'[{i+1}/{len(subs)}] {sub}')
+    sb.run(view_cmd(ssdir, ssbck), shell=True)
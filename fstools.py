@@ -1,3 +1,834 @@
+# NIfTI datatype codes and their bits per voxel
+NIFTI_TYPES = {2: 8, 4: 16, 8: 32, 16: 32, 32: 64, 64: 64, 128: 24, 256: 8, 512: 16, 768: 32, 1024: 64, 1280: 64, 1536: 128,
+    1792: 128, 2048: 256, 2304: 32}
+
+# MGH/MGZ voxel types and their bytes per voxel
+MGH_TYPES = {0: 1, 1: 4, 3: 4, 4: 2}
+
+
+def image_header(path):
+    """
+    Reads only the header of a NIfTI-1 (.nii, .nii.gz) or MGH (.mgh, .mgz) image, the voxel data is never loaded.
+    For the gzipped formats the first bytes are decompressed and the size of the whole uncompressed file
+    is taken from the gzip trailer. Returns dims, voxel sizes, datatype, bytes per voxel, where the data
+    starts, the size the file should have and the size it has. Raises ValueError for a broken header.
+    """
+    import gzip
+    import struct
+    from os import stat
+
+    size = stat(path).st_size
+    gz = path.endswith('.gz') or path.endswith('.mgz')
+    with open(path, 'rb') as f:
+        if gz:
+            if f.read(2) != b'\x1f\x8b':
+                raise ValueError('not a gzip file')
+            # ISIZE, the uncompressed size modulo 2**32, is in the last 4 bytes
+            f.seek(-4, 2)
+            size = struct.unpack('<I', f.read(4))[0]
+            f.seek(0)
+        try:
+            head = (gzip.GzipFile(fileobj=f) if gz else f).read(348)
+        except (OSError, EOFError) as e:
+            raise ValueError(f'header cannot be read: {e}')
+
+    if path.endswith('.mgh') or path.endswith('.mgz'):
+        if len(head) < 284:
+            raise ValueError('header is truncated')
+        version, w, h, d, frames, dtype, dof, good_ras = struct.unpack('>7ih', head[:30])
+        if version != 1:
+            raise ValueError(f'unknown MGH version {version}')
+        if dtype not in MGH_TYPES:
+            raise ValueError(f'unknown MGH type {dtype}')
+        dims = [w, h, d, frames]
+        voxel = list(struct.unpack('>3f', head[30:42])) if good_ras else [1.0, 1.0, 1.0]
+        offset, bpv = 284, MGH_TYPES[dtype]
+    else:
+        if len(head) < 348:
+            raise ValueError('header is truncated')
+        # the header size is 348 in the byte order of the file
+        endian = '<' if struct.unpack('<i', head[:4])[0] == 348 else '>'
+        if struct.unpack(endian + 'i', head[:4])[0] != 348:
+            raise ValueError('not a NIfTI-1 header')
+        dim = struct.unpack(endian + '8h', head[40:56])
+        dtype, bitpix = struct.unpack(endian + '2h', head[70:74])
+        pixdim = struct.unpack(endian + '8f', head[76:108])
+        offset = int(struct.unpack(endian + 'f', head[108:112])[0])
+        if not 1 <= dim[0] <= 7:
+            raise ValueError(f'bad number of dimensions {dim[0]}')
+        if dtype not in NIFTI_TYPES or NIFTI_TYPES[dtype] != bitpix:
+            raise ValueError(f'bad datatype {dtype} with {bitpix} bits per voxel')
+        dims = list(dim[1:dim[0] + 1])
+        voxel = list(pixdim[1:min(dim[0], 3) + 1])
+        bpv = bitpix / 8
+        if path.endswith('.nii') or path.endswith('.nii.gz'):
+            offset = max(offset, 352)
+
+    nvox = 1
+    for n in dims:
+        nvox *= n
+    return {'dims': dims, 'voxel': voxel, 'datatype': dtype, 'bytes_per_voxel': bpv, 'offset': offset,
+        'expected': int(offset + nvox * bpv), 'size': size, 'gzip': gz}
+
+
+def check_image(path):
+    """
+    Header-only integrity check of an image, returns None when it looks fine or what is wrong with it:
+    missing, unreadable header, zero or negative dimensions or voxel sizes, or a file smaller than the header says.
+    """
+    from math import isfinite
+
+    try:
+        hdr = image_header(path)
+    except FileNotFoundError:
+        return 'missing'
+    except (OSError, ValueError) as e:
+        return str(e)
+
+    if any(n <= 0 for n in hdr['dims']):
+        return f'bad dimensions {hdr["dims"]}'
+    if any(not isfinite(v) or v <= 0 for v in hdr['voxel']):
+        return f'bad voxel sizes {hdr["voxel"]}'
+    # gzip only keeps the size modulo 2**32, the size cannot be checked for bigger images
+    if hdr['gzip'] and hdr['expected'] >= 2**32:
+        return None
+    if hdr['size'] < hdr['expected']:
+        return f'truncated, {hdr["size"]} of {hdr["expected"]} bytes'
+    # a gzip file that was cut short ends in compressed data instead of the trailer, which reads as a random size,
+    # the MGH tags or NIfTI padding after the voxels are far below 1 MB
+    if hdr['gzip'] and hdr['size'] > hdr['expected'] + 2**20:
+        return f'gzip trailer says {hdr["size"]} bytes, the header {hdr["expected"]}, probably truncated'
+    return None
+
+
+def check_images(paths, workers=32):
+    """
+    Runs check_image on many files at once, the reads are small so this is bound by the latency of the storage.
+    Returns {path: problem} for the files with a problem.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        problems = dict(zip(paths, pool.map(check_image, paths)))
+    return {p: problem for p, problem in problems.items() if problem}
+
+
+def tree_io(pid):
+    """
+    I/O counters (/proc/<pid>/io) summed over a process and all its descendants.
+    Children that already exited are counted in their parent once they are reaped.
+    """
+    from os import listdir as ls
+
+    children = {}
+    for p in ls('/proc'):
+        if not p.isdigit():
+            continue
+        try:
+            with open(f'/proc/{p}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(p))
+        except (OSError, IndexError, ValueError):
+            pass
+
+    total, todo = {}, [pid]
+    while todo:
+        p = todo.pop()
+        todo += children.get(p, [])
+        try:
+            with open(f'/proc/{p}/io') as f:
+                for line in f:
+                    k, v = line.split(': ')
+                    total[k] = total.get(k, 0) + int(v)
+        except OSError:
+            pass
+    return total
+
+
+class segstate:
+    """
+    Local, crash-safe index of the segmentation state, kept in SQLite.
+    One row per subject x module with its status and the output files it produced, so
+    questions about what has been done are answered without touching the NAS.
+
+    Status is one of: todo, running, done, failed. A 'running' row left behind by a crash is
+    simply not 'done' and will be picked up again.
+
+    Parameters
+    ----------
+    db_path         : str   location of the sqlite file, keep it on a local disk
+    """
+    def __init__(self, db_path):
+
+        import sqlite3
+        from threading import Lock
+
+        self.db_path = db_path
+        self.lock = Lock()
+        self.db = sqlite3.connect(db_path, timeout=60, check_same_thread=False, isolation_level=None)
+        # WAL keeps the file consistent if we crash half way, and readers do not block the writers
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS status (subject TEXT, module TEXT, status TEXT, outputs TEXT, \
+            updated TEXT, fingerprint TEXT, PRIMARY KEY (subject, module))')
+        # indexes made before the fingerprints were added
+        if 'fingerprint' not in [c[1] for c in self.db.execute('PRAGMA table_info(status)')]:
+            self.db.execute('ALTER TABLE status ADD COLUMN fingerprint TEXT')
+        # hashes of the input files, valid as long as the size and mtime are the same
+        self.db.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT)')
+
+    def set(self, subject_id, module, status, outputs=(), fingerprint=None):
+        "Record the status of one module of one subject, with the fingerprint of the inputs it ran on"
+        import json
+        from datetime import datetime as dt
+
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO status (subject, module, status, outputs, updated, fingerprint) \
+                VALUES (?, ?, ?, ?, ?, ?)', (subject_id, module, status, json.dumps(list(outputs)), dt.now().isoformat(), fingerprint))
+
+    def set_many(self, rows):
+        "Record many (subject, module, status, outputs, fingerprint) rows in one transaction"
+        import json
+        from datetime import datetime as dt
+
+        now = dt.now().isoformat()
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR REPLACE INTO status (subject, module, status, outputs, updated, fingerprint) \
+                VALUES (?, ?, ?, ?, ?, ?)', [(sub, mod, st, json.dumps(list(out)), now, fp) for sub, mod, st, out, fp in rows])
+            self.db.execute('COMMIT')
+
+    def fingerprint(self, subject_id, module):
+        "Fingerprint recorded for one module of one subject, None if there is none"
+        with self.lock:
+            row = self.db.execute('SELECT fingerprint FROM status WHERE subject=? AND module=?', (subject_id, module)).fetchone()
+        return row[0] if row else None
+
+    def set_fingerprint(self, subject_id, module, fingerprint):
+        "Attach a fingerprint to an existing row, keeps the status and outputs"
+        with self.lock:
+            self.db.execute('UPDATE status SET fingerprint=? WHERE subject=? AND module=?', (fingerprint, subject_id, module))
+
+    def fingerprints(self):
+        "All the recorded fingerprints as {(subject, module): fingerprint}"
+        with self.lock:
+            rows = self.db.execute('SELECT subject, module, fingerprint FROM status WHERE fingerprint IS NOT NULL').fetchall()
+        return {(sub, mod): fp for sub, mod, fp in rows}
+
+    def file_hash(self, path):
+        """
+        Fast hash of a file, cached by path, size and mtime so an unchanged file is only stat-ed.
+        Files up to 4 MB are hashed whole. Of bigger ones only the size, the first and last MB and 64 blocks of
+        4 kB spread over the rest are read, for .mgz files the last bytes are the gzip CRC32 of the whole volume.
+        Returns None if the file does not exist.
+        """
+        from os import stat
+        from hashlib import blake2b
+
+        try:
+            st = stat(path)
+        except FileNotFoundError:
+            return None
+
+        with self.lock:
+            row = self.db.execute('SELECT hash FROM hashes WHERE path=? AND size=? AND mtime=?', (path, st.st_size, st.st_mtime_ns)).fetchone()
+        if row:
+            return row[0]
+
+        h = blake2b(str(st.st_size).encode(), digest_size=16)
+        with open(path, 'rb') as f:
+            if st.st_size <= 4 * 2**20:
+                h.update(f.read())
+            else:
+                h.update(f.read(2**20))
+                step = (st.st_size - 2 * 2**20) // 64
+                for i in range(64):
+                    f.seek(2**20 + i * step)
+                    h.update(f.read(4096))
+                f.seek(-2**20, 2)
+                h.update(f.read())
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)', (path, st.st_size, st.st_mtime_ns, h.hexdigest()))
+        return h.hexdigest()
+
+    def get(self, subject_id, module):
+        "Status of one module of one subject, None if it was never recorded"
+        with self.lock:
+            row = self.db.execute('SELECT status FROM status WHERE subject=? AND module=?', (subject_id, module)).fetchone()
+        return row[0] if row else None
+
+    def outputs(self, subject_id, module):
+        "Output files recorded for one module of one subject"
+        import json
+
+        with self.lock:
+            row = self.db.execute('SELECT outputs FROM status WHERE subject=? AND module=?', (subject_id, module)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def with_status(self, status):
+        "(subject, module) pairs with the given status"
+        with self.lock:
+            return self.db.execute('SELECT subject, module FROM status WHERE status=?', (status,)).fetchall()
+
+    def table(self):
+        "All the recorded statuses as {subject: {module: status}}"
+        with self.lock:
+            rows = self.db.execute('SELECT subject, module, status FROM status').fetchall()
+        out = {}
+        for sub, mod, st in rows:
+            out.setdefault(sub, {})[mod] = st
+        return out
+
+    def count(self):
+        "Number of rows in the index"
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM status').fetchone()[0]
+
+    def clear(self):
+        "Remove everything from the index"
+        with self.lock:
+            self.db.execute('DELETE FROM status')
+
+    def replace_all(self, rows):
+        "Replace the whole index with (subject, module, status, outputs, fingerprint) rows in one transaction"
+        import json
+        from datetime import datetime as dt
+
+        now = dt.now().isoformat()
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                self.db.execute('DELETE FROM status')
+                self.db.executemany('INSERT INTO status (subject, module, status, outputs, updated, fingerprint) \
+                    VALUES (?, ?, ?, ?, ?, ?)', [(sub, mod, st, json.dumps(list(out)), now, fp) for sub, mod, st, out, fp in rows])
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+
+class toolbox:
+    """
+    The sclimbic toolbox and the environment it runs in.
+    The toolbox is extracted once, from a local archive or from a download kept in cache_dir, after the archive is
+    checked against sha256. A lock (threads and a lock file for other processes) makes sure only one worker fetches it.
+    The environment of its setup.sh is captured once and reused to start mri_sclimbic_seg directly.
+
+    Parameters
+    ----------
+    path            : str   where the toolbox is extracted, sclimbic in the CWD by default
+    archive         : str   local toolbox tarball, downloaded from url when not given
+    sha256          : str   checksum the tarball has to match, not checked when not given
+    cache_dir       : str   where the downloaded tarball is kept
+    url             : str   where to download the toolbox from
+    """
+    def __init__(self, path='sclimbic', archive=None, sha256=None, cache_dir='~/.cache/mritools', \
+        url='https://surfer.nmr.mgh.harvard.edu/pub/dist/sclimbic/sclimbic-linux-20210725.tar.gz'):
+
+        from os.path import abspath, expanduser
+        from threading import Lock
+
+        self.path = abspath(expanduser(path))
+        self.archive = expanduser(archive) if archive else None
+        self.sha256 = sha256
+        self.cache_dir = expanduser(cache_dir)
+        self.url = url
+        self.lock = Lock()
+        self.environment = None
+
+    def checksum(self, archive):
+        "sha256 of the archive"
+        import hashlib
+
+        h = hashlib.sha256()
+        with open(archive, 'rb') as f:
+            for block in iter(lambda: f.read(4 << 20), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def fetch(self):
+        "Path to the toolbox tarball, downloaded to the cache dir if there is no local archive"
+        from os import makedirs, replace
+        from os.path import join, exists, basename
+        from urllib.request import urlretrieve
+
+        if self.archive:
+            return self.archive
+
+        makedirs(self.cache_dir, exist_ok=True)
+        archive = join(self.cache_dir, basename(self.url))
+        if not exists(archive):
+            print(f'Downloading {self.url}')
+            urlretrieve(self.url, archive + '.part')
+            replace(archive + '.part', archive)
+        return archive
+
+    def ensure(self):
+        "Makes sure the toolbox is extracted and returns its dir"
+        import tarfile
+        import shutil
+        import fcntl
+        from os import makedirs, rename, listdir as ls
+        from os.path import exists, join, dirname
+        from tempfile import mkdtemp
+
+        if exists(join(self.path, 'setup.sh')):
+            return self.path
+
+        with self.lock:
+            makedirs(self.cache_dir, exist_ok=True)
+            with open(join(self.cache_dir, 'toolbox.lock'), 'w') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                # someone else may have done it while we waited
+                if exists(join(self.path, 'setup.sh')):
+                    return self.path
+
+                archive = self.fetch()
+                if self.sha256:
+                    digest = self.checksum(archive)
+                    if digest != self.sha256:
+                        raise Exception(f'{archive} has sha256 {digest}, expected {self.sha256}')
+                else:
+                    print(f'Toolbox archive {archive} not checked, pass sha256={self.checksum(archive)} to pin it')
+
+                # extract next to the target and move it in place, a half extracted toolbox is never seen
+                tmp = mkdtemp(dir=dirname(self.path))
+                try:
+                    with tarfile.open(archive) as tar:
+                        if hasattr(tarfile, 'data_filter'):
+                            tar.extractall(tmp, filter='data')
+                        else:
+                            tar.extractall(tmp)
+                    extracted = ls(tmp)
+                    if exists(self.path):
+                        shutil.rmtree(self.path)
+                    rename(join(tmp, extracted[0]) if len(extracted) == 1 else tmp, self.path)
+                finally:
+                    if exists(tmp):
+                        shutil.rmtree(tmp)
+
+        return self.path
+
+    def env(self):
+        "Environment after sourcing the toolbox setup.sh, captured the first time and reused"
+        import subprocess as sp
+        from os import environ
+
+        with self.lock:
+            if self.environment is None:
+                out = sp.run(['bash', '-c', 'source "$FREESURFER_HOME/setup.sh" > /dev/null && env -0'],
+                    env=dict(environ, FREESURFER_HOME=self.path), capture_output=True, check=True).stdout
+                self.environment = dict(v.split('=', 1) for v in out.decode().split('\0') if '=' in v)
+        return self.environment
+
+
+class filecache:
+    """
+    Local, size-bounded copy of files from the NAS, the least recently used files are evicted first.
+    Files keep their remote layout under cache_dir, so tools that look for files next to the ones they
+    were given (e.g. freeview overlays and annotations) find them in the cache as well.
+    A cached file is used while the remote one has the same size and mtime.
+
+    Parameters
+    ----------
+    cache_dir       : str   where the cached files are kept
+    max_bytes       : int   the cache is trimmed to this size
+    workers         : int   parallel copies when prefetching
+    """
+    def __init__(self, cache_dir='~/.cache/mritools/files', max_bytes=20 * 2**30, workers=4):
+
+        import json
+        from os import makedirs
+        from os.path import expanduser, join, exists
+        from threading import Lock
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.cache_dir = expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending = {} # path -> future of a copy that is under way
+        self.index_path = join(self.cache_dir, 'index.json')
+
+        makedirs(self.cache_dir, exist_ok=True)
+        self.index = {} # remote path -> size, mtime and last use
+        if exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def local(self, path):
+        "Where a remote path lives in the cache"
+        from os.path import join, abspath
+        return join(self.cache_dir, abspath(path).lstrip('/'))
+
+    def save(self):
+        import json
+        from os import replace
+
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        replace(self.index_path + '.tmp', self.index_path)
+
+    def fetch(self, path):
+        "Copies the file into the cache unless the cached copy is current, returns the local path"
+        import shutil
+        from os import stat, makedirs, replace
+        from os.path import dirname, exists
+        from time import time
+
+        st = stat(path)
+        local = self.local(path)
+        entry = self.index.get(path)
+        if not (entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns and exists(local)):
+            makedirs(dirname(local), exist_ok=True)
+            shutil.copy2(path, local + '.part')
+            replace(local + '.part', local)
+
+        with self.lock:
+            self.index[path] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'used': time()}
+            self.evict(keep=path)
+            self.save()
+        return local
+
+    def get(self, path):
+        "Local copy of the file, waits for a prefetch of it if there is one"
+        with self.lock:
+            job = self.pending.get(path)
+        if job is not None:
+            try:
+                return job.result()
+            except OSError:
+                pass
+        return self.fetch(path)
+
+    def prefetch(self, paths):
+        "Starts copying the files in the background"
+        def run(path):
+            try:
+                return self.fetch(path)
+            finally:
+                with self.lock:
+                    self.pending.pop(path, None)
+
+        with self.lock:
+            for p in paths:
+                if p not in self.pending:
+                    self.pending[p] = self.pool.submit(run, p)
+
+    def evict(self, keep=None):
+        "Removes the least recently used files until the cache fits in max_bytes, call with the lock held"
+        from os import remove
+
+        total = sum(e['size'] for e in self.index.values())
+        for path in sorted(self.index, key=lambda p: self.index[p]['used']):
+            if total <= self.max_bytes:
+                break
+            if path in self.pending or path == keep:
+                continue
+            try:
+                remove(self.local(path))
+            except FileNotFoundError:
+                pass
+            total -= self.index.pop(path)['size']
+
+
+class backupstore:
+    """
+    Content-addressed, deduplicating store for backups of subject trees.
+    Every file is kept once under objects/ab/<blake2b of its content>, a backup of a subject is a small
+    snapshot manifest in snapshots/<name>.json that maps its paths to the objects. Backups of the same subject
+    before and after a fix share all the files the fix did not touch, so only the changed files are written.
+    Objects no snapshot refers to any more are removed by gc.
+
+    Parameters
+    ----------
+    root            : str   location of the store, the NAS is fine
+    workers         : int   files hashed, stored or restored at the same time
+    """
+    def __init__(self, root, workers=8):
+
+        from os import makedirs
+        from os.path import join, expanduser
+
+        self.root = expanduser(root)
+        self.workers = workers
+        self.objects = join(self.root, 'objects')
+        self.snapshots_dir = join(self.root, 'snapshots')
+        makedirs(self.objects, exist_ok=True)
+        makedirs(self.snapshots_dir, exist_ok=True)
+
+    def object_path(self, digest):
+        "Where the object with this hash is stored"
+        from os.path import join
+        return join(self.objects, digest[:2], digest)
+
+    def put(self, path, copy_to=None):
+        """
+        Stores one file unless an object with the same content is there already.
+        The file is read once into copy_to (the local working copy) or into a local temporary file while
+        it is hashed, the store only gets a copy of that when the object is new.
+        Returns its hash, its size and whether a new object was written.
+        """
+        import shutil
+        from hashlib import blake2b
+        from os import makedirs, replace, utime, remove
+        from os.path import dirname, exists
+        from tempfile import NamedTemporaryFile
+        from threading import get_ident
+
+        h = blake2b(digest_size=20)
+        size = 0
+        with open(path, 'rb') as fsrc, (open(copy_to, 'wb') if copy_to else NamedTemporaryFile(delete=False)) as spool:
+            for block in iter(lambda: fsrc.read(4 << 20), b''):
+                h.update(block)
+                spool.write(block)
+                size += len(block)
+
+        try:
+            digest = h.hexdigest()
+            target = self.object_path(digest)
+            new = not exists(target)
+            if new:
+                makedirs(dirname(target), exist_ok=True)
+                # the same content can be stored by two threads at once, each writes its own temporary file
+                part = f'{target}.{get_ident()}.part'
+                shutil.copyfile(spool.name, part)
+                replace(part, target)
+            else:
+                # a fresh mtime keeps gc from removing it before the manifest that uses it is written
+                utime(target)
+        finally:
+            if not copy_to:
+                remove(spool.name)
+
+        if copy_to:
+            shutil.copystat(path, copy_to)
+        return digest, size, new
+
+    def snapshot(self, src, name, copy_to=None):
+        """
+        Backs up the tree in src as snapshot name, links are followed and dangling ones skipped. Only the files whose content
+        is not in the store yet are written. With copy_to the tree is also copied there, reading src once.
+        Returns the path of the manifest.
+        """
+        import json
+        import os
+        import shutil
+        from os.path import join, relpath, exists
+        from datetime import datetime
+        from concurrent.futures import ThreadPoolExecutor
+
+        if not exists(src):
+            raise Exception(f'{src} does not exist')
+
+        files, dirs = [], []
+        for root, _, names in os.walk(src, followlinks=True):
+            rel = relpath(root, src)
+            dirs.append(rel)
+            if copy_to:
+                os.makedirs(join(copy_to, rel), exist_ok=True)
+            files += [os.path.normpath(join(rel, f)) for f in names]
+
+        dangling = [rel for rel in files if not exists(join(src, rel))]
+        if dangling:
+            print(f'Skipped {len(dangling)} dangling links in {src}: {" ".join(dangling)}')
+            files = [rel for rel in files if rel not in dangling]
+
+        def store(rel):
+            st = os.stat(join(src, rel))
+            digest, size, new = self.put(join(src, rel), join(copy_to, rel) if copy_to else None)
+            return rel, {'hash': digest, 'size': size, 'mtime': st.st_mtime, 'mode': st.st_mode & 0o7777}, new
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            stored = list(pool.map(store, files))
+        manifest = {'name': name, 'source': src, 'time': datetime.now().isoformat(), 'dirs': dirs,
+            'files': {rel: entry for rel, entry, _ in stored}}
+
+        if copy_to:
+            for rel in dirs:
+                shutil.copystat(join(src, rel), join(copy_to, rel))
+
+        path = join(self.snapshots_dir, f'{name}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(path + '.tmp', path)
+
+        total = sum(e['size'] for e in manifest['files'].values())
+        written = sum(e['size'] for _, e, new in stored if new)
+        print(f'Snapshot {name}: {len(files)} files ({total/2**20:.1f} MB), {sum(new for *_, new in stored)} new '
+            f'({written/2**20:.1f} MB written)')
+        return path
+
+    def manifest(self, name):
+        "The manifest of a snapshot"
+        import json
+        from os.path import join
+
+        with open(join(self.snapshots_dir, f'{name}.json')) as f:
+            return json.load(f)
+
+    def list(self, prefix=''):
+        "Names of the snapshots, optionally only the ones starting with prefix (e.g. a subject id)"
+        from os import listdir as ls
+        return sorted(f[:-5] for f in ls(self.snapshots_dir) if f.endswith('.json') and f.startswith(prefix))
+
+    def restore(self, name, dst):
+        """
+        Recreates the tree of a snapshot in dst, the files are copied in parallel. Every file is written
+        under a temporary name and renamed, with the mtime and permissions it had. Returns the number of files.
+        """
+        import os
+        import shutil
+        from os.path import join, dirname
+        from concurrent.futures import ThreadPoolExecutor
+
+        manifest = self.manifest(name)
+        for rel in manifest['dirs']:
+            os.makedirs(join(dst, rel), exist_ok=True)
+
+        def copy(item):
+            rel, entry = item
+            target = join(dst, rel)
+            os.makedirs(dirname(target), exist_ok=True)
+            shutil.copyfile(self.object_path(entry['hash']), target + '.part')
+            os.chmod(target + '.part', entry['mode'])
+            os.utime(target + '.part', (entry['mtime'], entry['mtime']))
+            os.replace(target + '.part', target)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(copy, manifest['files'].items()))
+
+        print(f'Restored {name} to {dst}: {len(manifest["files"])} files')
+        return len(manifest['files'])
+
+    def remove(self, name):
+        "Removes a snapshot, its objects stay until the next gc"
+        from os import remove
+        from os.path import join
+        remove(join(self.snapshots_dir, f'{name}.json'))
+
+    def gc(self, grace=3600, dry_run=False):
+        """
+        Removes the objects no snapshot refers to, and leftover temporary files.
+        Objects and temporary files younger than grace seconds are kept, they may belong to a snapshot
+        that is being written right now. Returns the number of objects and bytes removed.
+        """
+        from os import listdir as ls, stat, remove
+        from os.path import join, isdir
+        from time import time
+
+        used = set()
+        for name in self.list():
+            used.update(e['hash'] for e in self.manifest(name)['files'].values())
+
+        removed, freed = 0, 0
+        now = time()
+        for d in ls(self.objects):
+            folder = join(self.objects, d)
+            names = ls(folder) if isdir(folder) else [d]
+            folder = folder if isdir(folder) else self.objects
+            for f in names:
+                if f in used:
+                    continue
+                st = stat(join(folder, f))
+                if now - st.st_mtime < grace:
+                    continue
+                if not dry_run:
+                    remove(join(folder, f))
+                removed += 1
+                freed += st.st_size
+
+        print(f'{"Would remove" if dry_run else "Removed"} {removed} unreferenced objects ({freed/2**20:.1f} MB), '
+            f'{len(used)} objects in use')
+        return removed, freed
+
+
+class workqueue:
+    """
+    Shared queue of subjects that several seg processes, on one or more hosts, drain together.
+    A worker claims a subject with a lease and keeps it alive with heartbeats. When a worker dies its
+    lease runs out and the subject goes back to the queue, after max_attempts tries it is marked failed.
+    The queue is a SQLite file, on a shared filesystem it needs working file locks (NFS with locking,
+    not all SMB mounts), otherwise keep it on a local disk and run the workers on that host.
+
+    Parameters
+    ----------
+    db_path         : str   location of the queue file
+    lease           : int   seconds a claim is valid without a heartbeat
+    max_attempts    : int   claims a subject gets before it is given up on
+    """
+    def __init__(self, db_path, lease=900, max_attempts=3):
+
+        import sqlite3
+        from threading import Lock
+
+        self.db_path = db_path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.lock = Lock()
+        # no WAL here, it needs shared memory which does not work across hosts
+        self.db = sqlite3.connect(db_path, timeout=120, check_same_thread=False, isolation_level=None)
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs (subject TEXT PRIMARY KEY, status TEXT, owner TEXT, \
+            lease_until REAL, attempts INTEGER, updated REAL)')
+
+    def add(self, subjects):
+        "Queue the subjects, the ones already in the queue are left as they are"
+        from time import time
+
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.executemany('INSERT OR IGNORE INTO jobs VALUES (?, \'pending\', NULL, 0, 0, ?)',
+                [(s, time()) for s in subjects])
+            self.db.execute('COMMIT')
+
+    def claim(self, owner):
+        "Lease the next pending subject to owner, None when there is nothing left to do"
+        from time import time
+
+        with self.lock:
+            now = time()
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                # leases of crashed workers go back to the queue, or fail for good after max_attempts
+                self.db.execute('UPDATE jobs SET status=CASE WHEN attempts >= ? THEN \'failed\' ELSE \'pending\' END, \
+                    owner=NULL, updated=? WHERE status=\'leased\' AND lease_until < ?', (self.max_attempts, now, now))
+                row = self.db.execute('SELECT subject FROM jobs WHERE status=\'pending\' ORDER BY rowid LIMIT 1').fetchone()
+                if row:
+                    self.db.execute('UPDATE jobs SET status=\'leased\', owner=?, lease_until=?, attempts=attempts+1, updated=? \
+                        WHERE subject=?', (owner, now + self.lease, now, row[0]))
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        return row[0] if row else None
+
+    def heartbeat(self, owner, subjects):
+        "Extend the leases owner holds on the subjects"
+        from time import time
+
+        with self.lock:
+            self.db.executemany('UPDATE jobs SET lease_until=? WHERE subject=? AND owner=? AND status=\'leased\'',
+                [(time() + self.lease, s, owner) for s in subjects])
+
+    def complete(self, subject, owner, ok=True):
+        """
+        Mark a subject done, or after a failure put it back in the queue until it had max_attempts tries.
+        Returns False if owner had lost the lease in the meantime.
+        """
+        from time import time
+
+        with self.lock:
+            cur = self.db.execute('UPDATE jobs SET status=CASE WHEN ? THEN \'done\' WHEN attempts >= ? THEN \'failed\' \
+                ELSE \'pending\' END, updated=? WHERE subject=? AND owner=? AND status=\'leased\'',
+                (ok, self.max_attempts, time(), subject, owner))
+        return cur.rowcount == 1
+
+    def counts(self):
+        "Number of subjects in each status"
+        with self.lock:
+            return dict(self.db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+
 class seg:
     """
     Runs the segmentation algorithms on a set of freesurfer data.
@@ -9,7 +840,9 @@ class seg:
     subjects_dir    : str   location of freesurfer subjects_dir
     analysis_id     : str   name of the analysis
     pd_images_dir   : str   location of the PD images
-    threads         : int   number of threads to use
+    threads         : int   number of threads to use, with workers > 1 this is the total core budget
+                            that is split between the subjects running at the same time
+    workers         : int   number of subjects to process at the same time
     telegram        : bool  send notifications to telegram
     skip_existing   : bool  skip subjects that have been processed before
     hpc             : bool  run HPC segmentation
@@ -17,15 +850,61 @@ class seg:
     bss             : bool  run Brainstem segmentation
     hts             : bool  run Hypothalamus segmentation
     scl             : bool  run Subcortical Limbic segmentation
-
+    parallel_modules: bool  run the independent modules of a subject at the same time, threads are split between them
+    state_db        : str   location of the sqlite state index, defaults to <analysis_id>_state.sqlite in the CWD
+    scratch_dir     : str   local dir to stage the inputs in, the modules run there and only the new files are copied
+                            back to subjects_dir. The next subjects are prefetched while the current one runs.
+    journal         : str   JSONL file with the resources used by every module run, defaults to <analysis_id>_journal.jsonl
+    log_dir         : str   where the output of the modules is logged, as <log_dir>/<subject>/<module>.log,
+                            defaults to <analysis_id>_logs
+    sclimbic_archive: str   local sclimbic toolbox tarball, downloaded to ~/.cache/mritools when not given
+    sclimbic_sha256 : str   checksum the toolbox tarball has to match
+    auto_tune       : bool  pick the threads of each module and the number of workers from the journal before
+                            run_list starts, see tune
 
     """
-    def __init__(self, subjects_dir, analysis_id, pd_images_dir, threads=40, telegram=True, skip_existing=True, \
-        hpc=False, thn=False, bss=False, hts=False, scl=False):
+    # Module graph, each module lists the prerequisites that have to run (once per subject) before it.
+    # PD: PD image lookup, TBX: sclimbic toolbox setup. The modules only read the recon-all outputs
+    # and write separate files, so they do not depend on each other.
+    modules = {'HPC': ['PD'], 'THN': ['PD'], 'BSS': [], 'SCL': ['TBX']}
+
+    # Volume tables written by each module into <subject>/mri, collected by aggregate
+    volumes = {
+        'HPC': ['lh.hippoSfVolumes*{aid}*.txt', 'rh.hippoSfVolumes*{aid}*.txt', 'lh.amygNucVolumes*{aid}*.txt', 'rh.amygNucVolumes*{aid}*.txt'],
+        'THN': ['ThalamicNuclei*{aid}*volumes.txt'],
+        'BSS': ['brainstemSsVolumes*.txt'],
+        'SCL': ['{sub}_sclimbic*.csv'],
+    }
+
+    # Inputs of each module relative to the subject dir, their hashes (with the PD image when the module needs it,
+    # the module arguments and the FreeSurfer version) make the fingerprint that decides if an output is stale
+    inputs = {
+        'HPC': ['mri/aseg.mgz', 'mri/norm.mgz', 'surf/lh.white', 'surf/rh.white', 'surf/lh.pial', 'surf/rh.pial'],
+        'THN': ['mri/aseg.mgz', 'mri/norm.mgz', 'surf/lh.white', 'surf/rh.white', 'surf/lh.pial', 'surf/rh.pial'],
+        'BSS': ['mri/aseg.mgz', 'mri/norm.mgz', 'surf/lh.white', 'surf/rh.white', 'surf/lh.pial', 'surf/rh.pial'],
+        'SCL': ['mri/T1.mgz', 'mri/aseg.mgz', 'mri/norm.mgz'],
+    }
+
+    # Dirs of the subject copied to the scratch dir when staging
+    stage_dirs = ['mri', 'surf', 'label', 'scripts']
+
+    # Files in <subject>/mri that mark a module as done, {sub} and {aid} are the subject and analysis id
+    outputs = {
+        'HPC': ['lh.hippoSfVolumes*{aid}*.txt', 'rh.hippoSfVolumes*{aid}*.txt'],
+        'THN': ['ThalamicNuclei*{aid}*volumes.txt'],
+        'BSS': ['brainstemSsVolumes*.txt'],
+        'SCL': ['{sub}_sclimbic.mgz'],
+    }
+
+    def __init__(self, subjects_dir, analysis_id, pd_images_dir, threads=40, workers=1, telegram=True, skip_existing=True, \
+        hpc=False, thn=False, bss=False, hts=False, scl=False, parallel_modules=True, \
+        state_db=None, scratch_dir=None, journal=None, log_dir=None, sclimbic_archive=None, sclimbic_sha256=None, \
+        auto_tune=False):
 
         from os.path import exists, expanduser
         from time import perf_counter as ptime
         from datetime import datetime
+        from threading import Lock
 
         # add time to printout of the analysis so we know what time we started.
         
@@ -34,17 +913,43 @@ class seg:
         self.pd_images_dir = pd_images_dir
         self.telegram = telegram
         self.threads = threads
+        self.workers = max(1, int(workers))
         self.skip_existing = skip_existing
         self.ptime = ptime
         self.dt = datetime
         self.timings = [] # keep the durations for each subject
         self.errlog = f'{self.analysis_id}_errlog.txt'
+        self.lock = Lock() # guards the logs and timings when several subjects run at once
 
         self.hpc = hpc # HPC segmentation
         self.thn = thn # Thalamic Nuclei segmentation
         self.bss = bss # Brainstem segmentation
         self.hts = hts # Hypothalamus segmentation
         self.scl = scl # Subcortical Limbic segmentation
+        self.parallel_modules = parallel_modules
+        self.state = segstate(state_db if state_db else f'{self.analysis_id}_state.sqlite')
+        self.journal = journal if journal else f'{self.analysis_id}_journal.jsonl'
+        self.records = [] # journal records of this run
+        self.log_dir = log_dir if log_dir else f'{self.analysis_id}_logs'
+        self.log_bytes = 10 * 2**20 # each log rolls over at 10 MB
+        self.log_backups = 3
+        self.tail_lines = 200 # lines of output kept in memory for the error report
+        self.sclimbic = toolbox(archive=sclimbic_archive, sha256=sclimbic_sha256)
+        self.pd_index = {} # subject -> PD image, see build_pd_index
+        self.pd_problems = {} # subject -> why it has no usable PD image
+        self.fs_stamp = None # FreeSurfer build stamp, read once by fs_version
+        self.auto_tune = auto_tune
+        self.module_threads = {} # module -> threads, set by tune, overrides the even split of the threads
+
+        # Staging on the local disk
+        self.scratch_dir = expanduser(scratch_dir) if scratch_dir else None
+        if self.scratch_dir:
+            from os import makedirs
+            from concurrent.futures import ThreadPoolExecutor
+            makedirs(self.scratch_dir, exist_ok=True)
+            self.stager = ThreadPoolExecutor(max_workers=2) # copying in the background
+            self.staging = {} # subject -> future of its staged inputs
+            self.staged_subjects = set() # subjects that were staged or are running already
 
         if self.telegram:
             try:
@@ -73,217 +978,1006 @@ class seg:
         """
         Check if the subject has been processed before
         seg_type is the three-letter code of module, eg., HPC, THN, etc
+        The answer comes from the state index, a failed segmentation also counts as processed.
         """
-        from os.path import exists, join, expanduser
+        return self.state.get(subject_id, seg_type) in ('done', 'failed')
 
-        # check if there was an error with this sub and so the segmentation was not performed
-        if exists(f'{subject_id}_{seg_type}_seg_err.txt'):
-            return True
-        # FIXME the below is not good, requires analysisIDs to be different for each module,
-        # on the other hand, separare ids help when something has to be removed en masse
-        if exists(join(expanduser(self.subjects_dir), subject_id, 'mri', f'{self.analysis_id}.FSspace.mgz')):
-            return True
-        else:
+    def fs_version(self):
+        "FreeSurfer build stamp from $FREESURFER_HOME/build-stamp.txt, 'unknown' when it cannot be read"
+        from os import environ
+        from os.path import join
+
+        if self.fs_stamp is None:
+            try:
+                with open(join(environ.get('FREESURFER_HOME', ''), 'build-stamp.txt')) as f:
+                    self.fs_stamp = f.read().strip()
+            except OSError:
+                self.fs_stamp = 'unknown'
+        return self.fs_stamp
+
+    def fingerprint(self, subject_id, module):
+        """
+        Fingerprint of everything a module's output depends on: the hashes of its input files and of the PD image,
+        the module arguments without the threads and paths, and the FreeSurfer version.
+        The file hashes are cached in the state index, so for unchanged files this is only a stat each.
+        Returns None when an input is missing.
+        """
+        import json
+        from hashlib import blake2b
+        from os.path import join
+
+        hashes = {f: self.state.file_hash(join(self.subjects_dir, subject_id, f)) for f in self.inputs[module]}
+        prereq = {}
+        if 'PD' in self.modules[module]:
+            pd = self.pd_path(subject_id)
+            hashes['PD'] = self.state.file_hash(pd) if pd else None
+            prereq['PD'] = '{pd}'
+        if None in hashes.values():
+            return None
+
+        args = self.module_args(module, subject_id, 0, prereq, '{sdir}')
+        key = json.dumps({'inputs': hashes, 'args': args, 'freesurfer': self.fs_version()}, sort_keys=True)
+        return blake2b(key.encode(), digest_size=16).hexdigest()
+
+    def outputs_newer(self, subject_id, module):
+        "True if the recorded outputs of a module are newer than all of its inputs"
+        from os.path import join, getmtime
+
+        outputs = self.state.outputs(subject_id, module)
+        inputs = [join(self.subjects_dir, subject_id, f) for f in self.inputs[module]]
+        if 'PD' in self.modules[module]:
+            inputs.append(self.pd_path(subject_id))
+        try:
+            return len(outputs) > 0 and min(getmtime(join(self.subjects_dir, subject_id, f)) for f in outputs) >= \
+                max(getmtime(f) for f in inputs)
+        except (OSError, TypeError):
             return False
 
-    def data_info(self, list_ids=False):
+    def stale(self, subject_id, modules):
         """
-        Print information about the data. What has and what has not been processed so far.
+        Which of the modules have to run for the subject: the ones that are not done, and the done ones
+        whose inputs changed since (a different fingerprint). Returns them with the current fingerprints of
+        the done modules, the inputs of the others are only fingerprinted when they run.
+        Outputs done before fingerprints were recorded (or found by rebuild_state) are trusted when they are
+        newer than the inputs, and get the current fingerprint.
+        """
+        todo, fingerprints = [], {}
+        for m in modules:
+            if self.state.get(subject_id, m) != 'done':
+                todo.append(m)
+                continue
+            fp = self.fingerprint(subject_id, m)
+            fingerprints[m] = fp
+            if fp is None:
+                todo.append(m)
+                continue
+
+            old = self.state.fingerprint(subject_id, m)
+            if old is None and self.outputs_newer(subject_id, m):
+                self.state.set_fingerprint(subject_id, m, fp)
+            elif old != fp:
+                todo.append(m)
+
+        return todo, fingerprints
+
+    def find_outputs(self, subject_id, module, mri_files=None, sdir=None):
+        """
+        Output files of a module found in the subject's mri dir, empty if any of them is missing.
+        mri_files can be passed in to save listing the dir again, sdir overrides the subjects_dir.
         """
         from os import listdir as ls
-        from os.path import exists
+        from os.path import join, exists
+        from fnmatch import filter as fnfilter
+
+        if mri_files is None:
+            mri_dir = join(sdir if sdir else self.subjects_dir, subject_id, 'mri')
+            mri_files = ls(mri_dir) if exists(mri_dir) else []
+
+        found = []
+        for pattern in self.outputs[module]:
+            matches = fnfilter(mri_files, pattern.format(sub=subject_id, aid=self.analysis_id))
+            if len(matches) == 0:
+                return []
+            found += [join('mri', f) for f in matches]
+        return found
+
+    def rebuild_state(self, workers=16):
+        """
+        Rebuild the state index from the subjects_dir, this lists every subject's mri dir once
+        (in parallel) and picks up the error files from previous runs.
+        Subjects added to the subjects_dir afterwards are only seen by run_subject or another rebuild.
+        """
+        from os import listdir as ls
+        from os.path import join, exists
+        from concurrent.futures import ThreadPoolExecutor
 
-        # Get the subjects from the FS subjects_dir
         allSubjects = [s for s in ls(self.subjects_dir) if s.startswith('sub-')]
+        err_logged = set(s for s in ls() if s.endswith('_seg_err.txt'))
+        fingerprints = self.state.fingerprints() # outputs that are still there keep their fingerprint
+
+        def scan(subject_id):
+            mri_dir = join(self.subjects_dir, subject_id, 'mri')
+            mri_files = ls(mri_dir) if exists(mri_dir) else []
+            rows = []
+            for m in self.modules:
+                outputs = self.find_outputs(subject_id, m, mri_files)
+                if outputs:
+                    rows.append((subject_id, m, 'done', outputs, fingerprints.get((subject_id, m))))
+                elif f'{subject_id}_{m}_seg_err.txt' in err_logged:
+                    rows.append((subject_id, m, 'failed', [], None))
+                else:
+                    rows.append((subject_id, m, 'todo', [], None))
+            return rows
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            rows = [r for sub in pool.map(scan, allSubjects) for r in sub]
+
+        # in one transaction, an interrupted rebuild leaves the old index as it was
+        self.state.replace_all(rows)
+        print(f'State index rebuilt for {len(allSubjects)} subjects')
+
+    def data_info(self, list_ids=False, rebuild=False):
+        """
+        Print information about the data. What has and what has not been processed so far.
+        This reads the state index, it is rebuilt from the subjects_dir when empty or when rebuild is set.
+        """
+        if rebuild or self.state.count() == 0:
+            self.rebuild_state()
+
+        table = self.state.table()
+        modules = self.enabled_modules() or list(self.modules)
+
+        # Get the subjects from the state index
+        allSubjects = sorted(table)
         print(f'Data info for {self.analysis_id}.')
         print(f'Found a total of {len(allSubjects)} subjects in {self.subjects_dir}.')
 
-        # Get the subjects that have been processed
-        processedSubjects = [s for s in allSubjects if self.check_exists(s)]
-        print(f'{len(processedSubjects)} subjects have been processed.')
-
-        # Get the subjects that have not been processed
-        unprocessedSubjects = [s for s in allSubjects if not self.check_exists(s)]
-        print(f'{len(unprocessedSubjects)} subjects have not been processed.')
-
-        # List previous errors:
-        err_logged = [s for s in ls() if s.endswith('_seg_err.txt')]
-        print(f'Found {len(err_logged)} error logs.')
-        if list_ids:
-            print('details:')
-            for s in err_logged:
-                print(s)
-        
-        errSubjects = [s for s in unprocessedSubjects if s in err_logged]
-        print(f'That includes: {len(errSubjects)} subjects have not been processed due to a previous error.')
-        # IF details are required, print them
-        if list_ids:
-            print('details:')
-            for s in errSubjects:
-                print(s)
-
-        # List not processed:
-        unprocessedSubjects = [s for s in unprocessedSubjects if not s in errSubjects]
-        print(f'That includes: {len(unprocessedSubjects)} subjects have not been processed.')
-        # IF details are required, print them
-        if list_ids:
-            print('details:')
-            for s in unprocessedSubjects:
-                print(s)
+        for m in modules:
+            print(f'{m}:')
+            for status in ('done', 'failed', 'running', 'todo'):
+                subs = [s for s in allSubjects if table[s].get(m, 'todo') == status]
+                print(f'  {len(subs)} subjects are {status}.')
+                # IF details are required, print them
+                if list_ids and status != 'done':
+                    for s in subs:
+                        print(f'    {s}')
+
+        # Subjects with every module done
+        processedSubjects = [s for s in allSubjects if all(table[s].get(m) == 'done' for m in modules)]
+        print(f'{len(processedSubjects)} subjects have been processed with all of {", ".join(modules)}.')
         
     def progress_info(self, iteration):
         "Print progress info"
         from statistics import median as median
         from datetime import timedelta as td
 
-        # Print the mean time and how much time is left
+        # Print the mean time and how much time is left, subjects running in parallel finish workers at a time
         if len(self.timings) > 2:
-            print(f'M time per sub: {median(self.timings)/60} minutes. ETA: {self.dt.now() + td(minutes=((len(self.subjects)-iteration)*median(self.timings))/60)}')
+            left = (len(self.subjects)-iteration)*median(self.timings)/self.workers
+            print(f'M time per sub: {median(self.timings)/60} minutes. ETA: {self.dt.now() + td(minutes=left/60)}')
+
+        # Per module, from the journal of this run. Parallel modules take as long as the slowest one.
+        with self.lock:
+            records = [r for r in self.records if r['returncode'] == 0]
+        per_module = {m: median(r['wall'] for r in records if r['module'] == m) for m in set(r['module'] for r in records)}
+        if len(records) > 2 and per_module:
+            subject = max(per_module.values()) if self.parallel_modules else sum(per_module.values())
+            left = (len(self.subjects)-iteration)*subject/self.workers
+            print('M time per module: ' + ', '.join(f'{m} {w/60:.1f}' for m, w in sorted(per_module.items())) +
+                f' minutes. Module ETA: {self.dt.now() + td(seconds=left)}')
    
+    def log_error(self, subject_id, message):
+        "Log a problem with a subject that stopped it from being processed"
+        with self.lock, open(self.errlog, 'a') as f:
+            f.write(f'{self.dt.now()}\t{subject_id}\t{message}\n')
+
     def log_results(self, subject_id, segmentation, result):
         # pass result from the subprocess, it will save something if there was an error
         from datetime import datetime as dt
 
         if result.returncode != 0:
-            with open(self.errlog, 'a') as f:
+            with self.lock, open(self.errlog, 'a') as f:
                 f.write(f'{dt.now()}\t{subject_id}\t{segmentation} segmentation failed\n')
                 f.close()
 
-            print(f"Subject {subject_id} {segmentation} segmentation failed: {result.stderr.decode('utf-8')}")
+            print(f"Subject {subject_id} {segmentation} segmentation failed, full log in {self.log_path(subject_id, segmentation)}: {result.stderr.decode('utf-8')}")
             # Also save it for later
             with open(f'{subject_id}_{segmentation}_seg_err.txt', 'w') as f:
                 f.write(result.stderr.decode('utf-8'))
                 f.close()
             return None
 
-    def run_subject(self, subject_id):
+    def job_threads(self):
+        """
+        Threads given to each subject, the threads budget is split evenly between the workers
+        """
+        return max(1, self.threads // self.workers)
 
-        # Runs a single subject through all specified segmentations
+    def run_graph(self, tasks, deps, parallel=True):
+        """
+        Runs a small task graph.
+        tasks maps a name to a callable that takes the dict of results so far, deps maps a name
+        to the names that have to finish before it. Independent tasks run at the same time when
+        parallel is set. A task that fails or returns None makes its dependents be skipped.
+        """
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-        import subprocess as sp
-        from os.path import join, exists, abspath
-        from os import listdir as ls
+        results = {}
+        pending = dict(tasks)
+        running = {}
 
-        # Check subject id
-        if not subject_id.startswith('sub-'):
-            subject_id = f'sub-{subject_id}'
+        # nothing enabled, e.g. only hts which has no module yet
+        if len(tasks) == 0:
+            return results
 
-        # Check if the subject exists
-        if not exists(join(self.subjects_dir, subject_id)):
-            self.log_error(subject_id, 'Subject dir does not exist')
-            print(f"Subject {subject_id} does not exist")
-            return None
-        
-        # Check if the subject has a PD image
-        # list all PD images in mpm dir
+        with ThreadPoolExecutor(max_workers=len(tasks) if parallel else 1) as pool:
+            while pending or running:
+                # start everything that has its prerequisites done, skip those with failed prerequisites
+                changed = True
+                while changed:
+                    changed = False
+                    for name in list(pending):
+                        needs = deps.get(name, [])
+                        if not all(d in results for d in needs):
+                            continue
+                        task = pending.pop(name)
+                        changed = True
+                        if any(results[d] is None for d in needs):
+                            results[name] = None
+                        else:
+                            running[pool.submit(task, results)] = name
 
-        # Only run the PD check for analyses that require it
-        # TODO
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for job in done:
+                    name = running.pop(job)
+                    try:
+                        results[name] = job.result()
+                    except Exception as e:
+                        print(f'{name} failed: {e}')
+                        results[name] = None
+
+        # anything left never had its prerequisites available
+        for name in pending:
+            results[name] = None
+
+        return results
+
+    def scan_pd(self, subject_id):
+        """
+        Looks for the PD image of one subject, returns (path, None) or (None, problem)
+        """
+        from os.path import join
+        from os import listdir as ls
+
+        # list all PD images in mpm dir
+        try:
+            pd_images = [f for f in ls(join(self.pd_images_dir, subject_id, 'Results')) if f.endswith('PD.nii')]
+        except FileNotFoundError:
+            return None, 'PD image does not exist'
 
-        pd_images = [f for f in ls(join(self.pd_images_dir, subject_id, 'Results')) if f.endswith('PD.nii')]
-        
         if len(pd_images) == 0:
-            self.log_error(subject_id, 'PD image does not exist')
-            print(f"Subject {subject_id} does not have a PD image")
-            return None
+            return None, 'PD image does not exist'
         elif len(pd_images) > 1:
-            self.log_error(subject_id, 'Multiple PD images')
-            print(f"Subject {subject_id} has multiple PD images")
-            return None
+            return None, 'Multiple PD images'
         # otherwise we will have exactly one image -> pd_images[0]
-        
-        # Start the timer
-        tstart = self.ptime()
+        return join(self.pd_images_dir, subject_id, 'Results', pd_images[0]), None
 
-        if self.hpc:
-            # Run the HPC segmentation with additional PD scan
-            process = sp.run(f'export ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS={self.threads}; segmentHA_T2.sh {subject_id} \
-            {join(self.pd_images_dir, subject_id, "Results", pd_images[0])} \
-            {self.analysis_id} \
-            1 \
-            {self.subjects_dir}', shell=True, capture_output=True)
+    def build_pd_index(self, subjects=None, workers=16):
+        """
+        Scans the hMRI derivatives once, in parallel, and keeps subject -> PD image in self.pd_index.
+        Subjects without exactly one PD image end up in self.pd_problems with the reason.
+        Scans all the subjects in pd_images_dir when no list is given, the subjects scanned before stay in the index.
+        """
+        from os import listdir as ls
+        from concurrent.futures import ThreadPoolExecutor
 
-            self.log_results(subject_id, 'HPC', process)
+        if subjects is None:
+            subjects = [s for s in ls(self.pd_images_dir) if s.startswith('sub-')]
 
-        if self.thn:
-            # Run the THN segmentation with additional PD scan
-            process = sp.run(f'export ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS={self.threads}; \
-            segmentThalamicNuclei.sh {subject_id} \
-            {self.subjects_dir} \
-            {join(self.pd_images_dir, subject_id, "Results", pd_images[0])} \
-            {self.analysis_id} \
-            t2', shell=True, capture_output=True)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            found = dict(zip(subjects, pool.map(self.scan_pd, subjects)))
+
+        for s, (pd, problem) in found.items():
+            self.pd_index.pop(s, None)
+            self.pd_problems.pop(s, None)
+            if pd:
+                self.pd_index[s] = pd
+            else:
+                self.pd_problems[s] = problem
+        print(f'PD index: {len(self.pd_index)} subjects with a PD image, {len(self.pd_problems)} with problems')
+
+    def pd_path(self, subject_id):
+        "PD image of the subject or None, the Results dir is only listed for subjects that are not in the index yet"
+        if subject_id not in self.pd_index and subject_id not in self.pd_problems:
+            pd, problem = self.scan_pd(subject_id)
+            if pd:
+                self.pd_index[subject_id] = pd
+            else:
+                self.pd_problems[subject_id] = problem
+        return self.pd_index.get(subject_id)
+
+    def preflight(self, subject_list):
+        """
+        Checks the whole cohort before anything runs: the subject dirs and, when a module needs it, the PD images.
+        The headers of the module inputs and PD images are read to catch broken images, see check_image.
+        Every problem is printed and logged, the subjects that are fine are returned.
+        """
+        from os import listdir as ls
+        from os.path import join, relpath
+
+        problems = {}
+        fs_subjects = set(ls(self.subjects_dir))
+        for s in subject_list:
+            if s not in fs_subjects:
+                problems[s] = 'Subject dir does not exist'
+
+        if any('PD' in self.modules[m] for m in self.enabled_modules()):
+            # run_list indexed the subjects already, only the ones that are not in the index are scanned
+            missing = [s for s in subject_list if s not in problems and s not in self.pd_index and s not in self.pd_problems]
+            if missing:
+                self.build_pd_index(missing)
+            problems.update({s: self.pd_problems[s] for s in subject_list if s in self.pd_problems and s not in problems})
+
+        # header-only checks of the inputs, a truncated image would otherwise fail hours into a module
+        inputs = sorted(set(f for m in self.enabled_modules() for f in self.inputs[m] if f.endswith('.mgz')))
+        images = {}
+        for s in subject_list:
+            if s not in problems:
+                for f in inputs:
+                    images[join(self.subjects_dir, s, f)] = s
+                if s in self.pd_index:
+                    images[self.pd_index[s]] = s
+        for path, problem in check_images(list(images)).items():
+            s = images[path]
+            problems[s] = f'{problems[s]}; ' if s in problems else ''
+            problems[s] += f'{relpath(path, self.subjects_dir) if path.startswith(self.subjects_dir) else path}: {problem}'
+
+        if problems:
+            print(f'Preflight found problems with {len(problems)} subjects, they will be skipped:')
+            for s, problem in sorted(problems.items()):
+                print(f'    {s}: {problem}')
+                self.log_error(s, problem)
+
+        return [s for s in subject_list if s not in problems]
+
+    def find_pd(self, subject_id):
+        """
+        Returns the path to the PD image of the subject, or None if there is not exactly one.
+        Uses the PD index when the subject was in it, lists the Results dir otherwise.
+        """
+        if subject_id in self.pd_index:
+            return self.pd_index[subject_id]
+        if subject_id in self.pd_problems:
+            pd, problem = None, self.pd_problems[subject_id]
+        else:
+            pd, problem = self.scan_pd(subject_id)
 
-            self.log_results(subject_id, 'THN', process)
+        if problem:
+            self.log_error(subject_id, problem)
+            print(f"Subject {subject_id}: {problem}")
+        return pd
 
-        if self.bss:
-            # TODO
+    def get_sclimbic(self):
+        """
+        The sclimbic segmentation is relatively new and requires dev version of freesurfer or
+        a standalone toolbox, see the toolbox class. Returns the dir of the extracted toolbox.
+        """
+        return self.sclimbic.ensure()
+
+    def module_args(self, module, subject_id, threads, prereq, sdir):
+        """
+        Arguments of the command for one module, prereq holds the results of the prerequisites (PD image)
+        and sdir is the subjects_dir to run in
+        """
+        from os.path import join
+
+        if module == 'HPC':
+            # Run the HPC segmentation with additional PD scan
+            return ['segmentHA_T2.sh', subject_id, prereq['PD'], self.analysis_id, '1', sdir]
+
+        if module == 'THN':
+            # Run the THN segmentation with additional PD scan
+            return ['segmentThalamicNuclei.sh', subject_id, sdir, prereq['PD'], self.analysis_id, 't2']
+
+        if module == 'BSS':
             # Run the BS segmentation
             # simple process, does not require any additional scans and does not take analysis ID
-            process = sp.run(f'export ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS={self.threads}; \
-            segmentBS.sh {subject_id} {self.subjects_dir}', shell=True, capture_output=True)
-            
-            self.log_results(subject_id, 'BSS', process)
+            return ['segmentBS.sh', subject_id, sdir]
+
+        if module == 'SCL':
+            # TODO checking of prior files in the fs dir will not work here, can be skipped.
+            # Set the paths to the files
+            t1_mgz = join(sdir, subject_id, 'mri', 'T1.mgz')
+            sclimbic_mgz = join(sdir, subject_id, 'mri', f'{subject_id}_sclimbic.mgz')
+            return ['mri_sclimbic_seg', '--i', t1_mgz, '--o', sclimbic_mgz, '--write_volumes', '--write_qa_stats',
+                '--etiv', '--threads', str(threads)]
+
+        raise Exception(f'Unknown module {module}')
+
+    def module_cmd(self, module, subject_id, threads, prereq, sdir=None):
+        """
+        Builds the command for one module, prereq holds the results of the prerequisites (PD image, toolbox)
+        sdir is the subjects_dir to run in, the local scratch copy when staging
+        Returns the arguments and the environment, the tools are started directly without a shell.
+        """
+        from os import environ
+
+        if sdir is None:
+            sdir = self.subjects_dir
+
+        args = self.module_args(module, subject_id, threads, prereq, sdir)
+        if module == 'SCL':
+            # the toolbox environment is captured once, see toolbox.env
+            return args, self.sclimbic.env()
+        return args, dict(environ, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(threads))
+
+    def execute(self, subject_id, module, cmd, threads, env=None):
+        """
+        Runs the command of a module and writes what it used to the journal: wall time, CPU time of the
+        children, max RSS (from wait4) and bytes read/written (sampled from /proc/<pid>/io of the process tree).
+        The output (stdout and stderr together) is streamed to the rotating log of the subject and module,
+        only the last tail_lines are kept in memory. Returns a CompletedProcess with that tail as stderr.
+        """
+        import subprocess as sp
+        import logging
+        from logging.handlers import RotatingFileHandler
+        from collections import deque
+        from os import wait4, waitstatus_to_exitcode, WNOHANG, makedirs
+        from os.path import dirname, exists
+        from threading import Thread
+        from time import sleep
+
+        log = self.log_path(subject_id, module)
+        makedirs(dirname(log), exist_ok=True)
+        handler = RotatingFileHandler(log, maxBytes=self.log_bytes, backupCount=self.log_backups)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        if exists(log) and handler.stream.tell() > 0:
+            handler.doRollover() # keep the log of the previous run as .1
+        tail = deque(maxlen=self.tail_lines)
+
+        def stream(pipe):
+            for line in iter(pipe.readline, b''):
+                tail.append(line)
+                handler.emit(logging.makeLogRecord({'msg': line.decode('utf-8', 'replace').rstrip('\n')}))
+
+        tstart = self.ptime()
+        try:
+            proc = sp.Popen(cmd, env=env, stdout=sp.PIPE, stderr=sp.STDOUT)
+        except OSError as e:
+            # e.g. the tool is not on the PATH, report it like a failed run
+            handler.emit(logging.makeLogRecord({'msg': f'Could not start {cmd[0]}: {e}'}))
+            handler.close()
+            return sp.CompletedProcess(cmd, 127, None, f'Could not start {cmd[0]}: {e}\n'.encode())
+
+        # the output is streamed in the background, the main loop has to keep polling /proc
+        readers = [Thread(target=stream, args=(proc.stdout,))]
+        for r in readers:
+            r.start()
+
+        # poll often at first so short runs are not held up, then once a second
+        io, interval = {}, 0.02
+        while True:
+            io = max(io, tree_io(proc.pid), key=lambda x: x.get('rchar', 0) + x.get('wchar', 0))
+            pid, status, usage = wait4(proc.pid, WNOHANG)
+            if pid:
+                break
+            sleep(interval)
+            interval = min(1, interval * 2)
+        proc.returncode = waitstatus_to_exitcode(status)
+        for r in readers:
+            r.join()
+        handler.close()
+        wall = self.ptime() - tstart
+
+        self.record({'time': self.dt.now().isoformat(), 'subject': subject_id, 'module': module, 'threads': threads,
+            'workers': self.workers, 'wall': wall, 'cpu_user': usage.ru_utime, 'cpu_sys': usage.ru_stime,
+            'max_rss_kb': usage.ru_maxrss, 'read_bytes': io.get('read_bytes', 0), 'write_bytes': io.get('write_bytes', 0),
+            'rchar': io.get('rchar', 0), 'wchar': io.get('wchar', 0), 'returncode': proc.returncode})
+
+        return sp.CompletedProcess(cmd, proc.returncode, None, b''.join(tail))
+
+    def log_path(self, subject_id, module):
+        "Log file of a module run on a subject"
+        from os.path import join
+        return join(self.log_dir, subject_id, f'{module}.log')
+
+    def follow(self, subject_id=None, module=None, interval=1):
+        """
+        Print the output of the running jobs as it comes, like tail -f on all their logs.
+        Can be limited to one subject and/or module. Stops when nothing is running anymore, or with Ctrl+C.
+        This can be called from another process with the same analysis_id, the running jobs come from the state index.
+        """
+        from os.path import exists
+        from time import sleep
+
+        positions = {}
+        try:
+            while True:
+                running = [(s, m) for s, m in self.state.with_status('running')
+                    if (subject_id is None or s == subject_id) and (module is None or m == module)]
+                if not running and not positions:
+                    print('Nothing is running.')
+                    return
+                # the jobs that just finished are read once more to the end
+                for s, m in running + [k for k in positions if k not in running]:
+                    log = self.log_path(s, m)
+                    if not exists(log):
+                        continue
+                    with open(log, 'rb') as f:
+                        f.seek(0, 2)
+                        end = f.tell()
+                        pos = positions.get((s, m), max(0, end - 2000))
+                        if end < pos:
+                            pos = 0 # the log was rotated
+                        f.seek(pos)
+                        for line in f.read().decode('utf-8', 'replace').splitlines():
+                            print(f'[{s} {m}] {line}')
+                        positions[(s, m)] = f.tell()
+                positions = {k: v for k, v in positions.items() if k in running}
+                if not running:
+                    return
+                sleep(interval)
+        except KeyboardInterrupt:
+            return
+
+    def record(self, entry):
+        "Append a record to the journal"
+        import json
+
+        with self.lock:
+            self.records.append(entry)
+            with open(self.journal, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def read_journal(self):
+        "All the records in the journal file, from this and the previous runs"
+        import json
+        from os.path import exists
+
+        if not exists(self.journal):
+            return []
+        with open(self.journal) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def journal_summary(self, records=None):
+        """
+        Print per-module statistics from the journal: median wall and CPU time, how many cores were
+        actually busy (CPU time / wall), I/O rates, throughput and how the wall time scales with threads.
+        Returns the statistics as a dict.
+        """
+        from statistics import median
+        from datetime import datetime as dt
+
+        records = [r for r in (records if records is not None else self.read_journal()) if r['returncode'] == 0]
+        if len(records) == 0:
+            print('Nothing in the journal yet.')
+            return {}
+
+        summary = {}
+        for m in sorted(set(r['module'] for r in records)):
+            rs = [r for r in records if r['module'] == m]
+            wall = median(r['wall'] for r in rs)
+            cpu = median(r['cpu_user'] + r['cpu_sys'] for r in rs)
+            busy = cpu / wall if wall > 0 else 0
+            io = median((r['rchar'] + r['wchar']) / r['wall'] for r in rs if r['wall'] > 0) / 2**20
+
+            # threads vs speedup, relative to the fewest threads we have data for
+            scaling = {t: median(r['wall'] for r in rs if r['threads'] == t) for t in sorted(set(r['threads'] for r in rs))}
+            base = min(scaling)
+            speedup = {t: scaling[base] / w for t, w in scaling.items()}
+
+            summary[m] = {'runs': len(rs), 'wall': wall, 'cpu': cpu, 'busy_cores': busy, 'io_mb_s': io,
+                'max_rss_mb': max(r['max_rss_kb'] for r in rs) / 1024, 'scaling': scaling, 'speedup': speedup}
+
+            bound = 'CPU-bound' if busy >= 0.7 * median(r['threads'] for r in rs) else 'waiting on I/O or serial'
+            print(f'{m}: {len(rs)} runs, M wall {wall/60:.1f} min, M CPU {cpu/60:.1f} min, {busy:.1f} cores busy ({bound}), '
+                f'{io:.1f} MB/s, max RSS {summary[m]["max_rss_mb"]:.0f} MB')
+            for t in scaling:
+                print(f'    {t} threads: M wall {scaling[t]/60:.1f} min, speedup {speedup[t]:.2f}x')
+
+        # throughput over the span of the journal
+        times = sorted(dt.fromisoformat(r['time']) for r in records)
+        span = (times[-1] - times[0]).total_seconds() + median(r['wall'] for r in records)
+        subjects = len(set(r['subject'] for r in records))
+        summary['subjects_per_hour'] = subjects / span * 3600
+        print(f'Throughput: {subjects} subjects in {span/3600:.1f} hours, {summary["subjects_per_hour"]:.1f} subjects/hour')
+
+        return summary
+
+    def fit_scaling(self, records=None):
+        """
+        Fits T = a + b/p (Amdahl) to the wall time T of each module against its threads p, from the successful
+        runs in the journal. a is the serial part and b the part that scales, both in seconds.
+        With a single thread count the CPU time of the runs is used as b. Returns {module: fit}.
+        """
+        from statistics import mean, median
+
+        records = [r for r in (records if records is not None else self.read_journal()) if r['returncode'] == 0]
+        fits = {}
+        for m in sorted(set(r['module'] for r in records)):
+            rs = [r for r in records if r['module'] == m]
+            x = [1 / max(1, r['threads']) for r in rs]
+            y = [r['wall'] for r in rs]
+            counts = sorted(set(r['threads'] for r in rs))
+
+            if len(counts) > 1:
+                # least squares in 1/p
+                mx, my = mean(x), mean(y)
+                b = sum((xi - mx) * (yi - my) for xi, yi in zip(x, y)) / sum((xi - mx) ** 2 for xi in x)
+                a = my - b * mx
+                if b < 0:
+                    a, b = my, 0.0
+                elif a < 0:
+                    a, b = 0.0, sum(xi * yi for xi, yi in zip(x, y)) / sum(xi ** 2 for xi in x)
+            else:
+                # only one thread count, the CPU time is roughly the work that is spread over the threads
+                b = median(r['cpu_user'] + r['cpu_sys'] for r in rs)
+                a = max(0.0, median(y) - b / counts[0])
+
+            fits[m] = {'a': a, 'b': b, 'runs': len(rs), 'threads_tried': counts,
+                'rss_mb': max(r['max_rss_kb'] for r in rs) / 1024}
+        return fits
+
+    def plan(self, fits, modules, cores, memory_mb, subjects):
+        """
+        Chooses the threads of each module and the number of subjects running at once that finish the cohort
+        soonest on this machine, using the fits of fit_scaling.
+        With parallel_modules the modules of a subject share its threads and it takes as long as the slowest one,
+        otherwise they run one after the other with all of them. The memory the modules used limits the workers.
+        Returns (makespan in seconds, workers, {module: threads}).
+        """
+        from math import ceil
+
+        T = lambda m, p: fits[m]['a'] + fits[m]['b'] / p
+        rss = sum(fits[m]['rss_mb'] for m in modules) if self.parallel_modules else max(fits[m]['rss_mb'] for m in modules)
+
+        best = None
+        for workers in range(1, cores + 1):
+            if workers * rss > memory_mb and workers > 1:
+                break
+            budget = cores // workers
+            if self.parallel_modules and budget < len(modules):
+                if workers > 1:
+                    break
+                # fewer cores than modules, they get a thread each and share the cores
+                threads = {m: 1 for m in modules}
+                subject = max(max(T(m, 1) for m in modules), sum(T(m, 1) for m in modules) / budget)
+            elif self.parallel_modules:
+                # start with a thread each and keep giving one to the slowest module while it helps
+                threads = {m: 1 for m in modules}
+                while sum(threads.values()) < budget:
+                    slowest = max(modules, key=lambda m: T(m, threads[m]))
+                    if T(slowest, threads[slowest] + 1) >= T(slowest, threads[slowest]):
+                        break
+                    threads[slowest] += 1
+                subject = max(T(m, threads[m]) for m in modules)
+            else:
+                threads = {m: budget for m in modules}
+                subject = sum(T(m, budget) for m in modules)
+
+            makespan = ceil(subjects / workers) * subject
+            if best is None or makespan < best[0]:
+                best = (makespan, workers, threads)
+        return best
+
+    def tune(self, subjects=None, cores=None, memory_mb=None, apply=False):
+        """
+        Auto-tune: fits how each enabled module scales with threads (see fit_scaling) and plans the per-module
+        threads and the number of workers that finish the cohort soonest on this machine (see plan).
+        This is a dry run by default, it prints the plan and the predicted makespan next to the current setting.
+        With apply the plan is used by the next run_list. A module that only ran with one thread count
+        so far is given a different one, so the journal gets the data for a better fit.
+        Returns the plan as a dict.
+        """
+        from os import cpu_count, sysconf
+        from math import ceil
+        from datetime import timedelta as td
+
+        cores = cores if cores else cpu_count()
+        memory_mb = memory_mb if memory_mb else sysconf('SC_PHYS_PAGES') * sysconf('SC_PAGE_SIZE') / 2**20
+        n = len(subjects) if subjects is not None else max(1, len(set(s for s, m in self.state.with_status('todo'))))
+        modules = self.enabled_modules()
+
+        fits = self.fit_scaling()
+        missing = [m for m in modules if m not in fits]
+        if missing or len(modules) == 0:
+            print(f'Auto-tune: no runs in {self.journal} yet for {", ".join(missing) or "any module"}, keeping the threads as they are')
+            return {}
+
+        print(f'Auto-tune for {n} subjects on {cores} cores and {memory_mb/1024:.0f} GB:')
+        makespan, workers, threads = self.plan(fits, modules, cores, memory_mb, n)
+
+        # exploring a thread count that was not tried yet
+        explore = {}
+        for m in modules:
+            if len(fits[m]['threads_tried']) == 1:
+                tried = fits[m]['threads_tried'][0]
+                explore[m] = max(1, tried // 2) if tried > 1 else min(2, cores)
+
+        for m in modules:
+            f = fits[m]
+            t = explore.get(m, threads[m])
+            note = f', exploring {t} threads (only tried {f["threads_tried"][0]})' if m in explore else ''
+            print(f'    {m}: T = {f["a"]/60:.1f} + {f["b"]/60:.1f}/p min from {f["runs"]} runs, {threads[m]} threads '
+                f'-> {(f["a"] + f["b"]/threads[m])/60:.1f} min{note}')
+
+        # what the current setting would take, with the threads split as run_subject does it
+        per_subject = max(1, self.threads // self.workers)
+        current = max(1, per_subject // len(modules)) if self.parallel_modules else per_subject
+        T = lambda m, p: fits[m]['a'] + fits[m]['b'] / max(1, p)
+        subject = max(T(m, current) for m in modules) if self.parallel_modules else sum(T(m, current) for m in modules)
+        # more threads than cores share them
+        used = self.workers * current * (len(modules) if self.parallel_modules else 1)
+        now = ceil(n / self.workers) * subject * max(1, used / cores)
+
+        print(f'    {workers} subjects at once, predicted makespan {td(seconds=round(makespan))} '
+            f'({n / makespan * 3600:.1f} subjects/hour)')
+        print(f'    current setting ({self.workers} workers, {self.threads} threads): {td(seconds=round(now))}')
+
+        if apply:
+            self.workers = workers
+            self.threads = workers * sum(threads.values()) if self.parallel_modules else workers * max(threads.values())
+            self.module_threads = dict(threads, **explore)
+        else:
+            print('    dry run, nothing changed')
+
+        return {'workers': workers, 'threads': threads, 'explore': explore, 'makespan': makespan, 'current': now, 'fits': fits}
+
+    def run_module(self, module, subject_id, threads, prereq, sdir=None, fingerprint=None):
+        """
+        Runs a single module on a subject, returns True when it finished without an error
+        fingerprint is the one of the inputs the module runs on, it is recorded with the outputs
+        """
+        self.state.set(subject_id, module, 'running')
+
+        cmd, env = self.module_cmd(module, subject_id, threads, prereq, sdir)
+        process = self.execute(subject_id, module, cmd, threads, env)
+        self.log_results(subject_id, module, process)
+
+        outputs = self.find_outputs(subject_id, module, sdir=sdir) if process.returncode == 0 else []
+        self.state.set(subject_id, module, 'done' if process.returncode == 0 else 'failed', outputs,
+            fingerprint if process.returncode == 0 else None)
+
+        return process.returncode == 0
+
+    def stage_in(self, subject_id):
+        """
+        Copies the inputs the modules need (mri, surf, label, scripts and the PD image) to the scratch dir.
+        Returns the local subjects_dir, the local PD image and a snapshot of what was copied,
+        which stage_out uses to send back only the new files.
+        """
+        import shutil
+        from os import makedirs, walk, stat
+        from os.path import join, exists, basename, relpath
+
+        local = join(self.scratch_dir, subject_id)
+        if exists(local):
+            shutil.rmtree(local)
+
+        for d in self.stage_dirs:
+            if exists(join(self.subjects_dir, subject_id, d)):
+                shutil.copytree(join(self.subjects_dir, subject_id, d), join(local, d))
+
+        # the PD image is only needed by some of the modules
+        pd = None
+        if any('PD' in self.modules[m] for m in self.enabled_modules()):
+            remote_pd = self.find_pd(subject_id)
+            if remote_pd:
+                makedirs(join(local, 'pd'), exist_ok=True)
+                pd = join(local, 'pd', basename(remote_pd))
+                shutil.copy2(remote_pd, pd)
+
+        snapshot = {}
+        for root, _, files in walk(local):
+            for f in files:
+                st = stat(join(root, f))
+                snapshot[relpath(join(root, f), local)] = (st.st_size, st.st_mtime_ns)
+
+        return {'sdir': self.scratch_dir, 'pd': pd, 'snapshot': snapshot}
+
+    def stage_out(self, subject_id, staged):
+        """
+        Copies the files that are new or changed since stage_in back to the subjects_dir and
+        removes the local copy. Each file is written under a temporary name and then renamed.
+        """
+        import shutil
+        from os import makedirs, walk, stat, replace
+        from os.path import join, relpath, dirname
+
+        local = join(staged['sdir'], subject_id)
+        remote = join(self.subjects_dir, subject_id)
+        sent = 0
+        for root, _, files in walk(local):
+            for f in files:
+                rel = relpath(join(root, f), local)
+                if rel.startswith('pd'):
+                    continue
+                st = stat(join(root, f))
+                if staged['snapshot'].get(rel) == (st.st_size, st.st_mtime_ns):
+                    continue
+                makedirs(dirname(join(remote, rel)), exist_ok=True)
+                shutil.copy2(join(root, f), join(remote, rel) + '.part')
+                replace(join(remote, rel) + '.part', join(remote, rel))
+                sent += 1
+
+        shutil.rmtree(local)
+        print(f'Synced {sent} new files for {subject_id} back to {self.subjects_dir}')
+
+    def staged_inputs(self, subject_id):
+        "Waits for the prefetched inputs of the subject, or stages them now if they were not prefetched"
+        with self.lock:
+            job = self.staging.pop(subject_id, None)
+        if job is None:
+            return self.stage_in(subject_id)
+        return job.result()
+
+    def prefetch(self, subject_id):
+        """
+        Starts pulling the inputs of the subjects queued after this one, one per worker,
+        so the copying overlaps with the current computation
+        """
+        subjects = getattr(self, 'subjects', [])
+        if subject_id not in subjects:
+            return
+        i = subjects.index(subject_id)
+        with self.lock:
+            for nxt in subjects[i+1:i+1+self.workers]:
+                if nxt not in self.staging and nxt not in self.staged_subjects:
+                    self.staged_subjects.add(nxt)
+                    self.staging[nxt] = self.stager.submit(self.stage_in, nxt)
+
+    def run_subject(self, subject_id, threads=None):
+
+        # Runs a single subject through all specified segmentations
+        # threads overrides self.threads, run_list uses it to split the core budget between workers
+        # The enabled modules are turned into a graph (see self.modules), the prerequisites run once
+        # and with parallel_modules the modules themselves run at the same time sharing the threads
+
+        from os.path import join, exists
+
+        # Check subject id
+        if not subject_id.startswith('sub-'):
+            subject_id = f'sub-{subject_id}'
+
+        # Check if the subject exists
+        if not exists(join(self.subjects_dir, subject_id)):
+            self.log_error(subject_id, 'Subject dir does not exist')
+            print(f"Subject {subject_id} does not exist")
+            return None
+
+        if threads is None:
+            threads = self.threads
+
+        if self.scratch_dir:
+            with self.lock:
+                self.staged_subjects.add(subject_id)
 
         if self.hts:
             # only in FS 7.2+, use singularity container maybe?
             pass
 
-        if self.scl:
-            # Run the sclimbic segmentation, it is relatively new and requires dev version of freesurfer or
-            # a standalone toolbox, that this will download if not found in the dir.
-            # TODO checking of prior files in the fs dir will not work here, can be skipped. 
-            
-            if not exists ('sclimbic'):
-                # Get the toolbox
-                sp.run('wget https://surfer.nmr.mgh.harvard.edu/pub/dist/sclimbic/sclimbic-linux-20210725.tar.gz', shell=True)
-                sp.run('tar -xvf sclimbic-linux-20210725.tar.gz', shell=True)
-                sp.run('rm sclimbic-linux-20210725.tar.gz', shell=True)
+        # only the modules that are not done or whose inputs changed since, see stale
+        modules = self.enabled_modules()
+        todo, fingerprints = self.stale(subject_id, modules)
+        if self.skip_existing:
+            modules = todo
+            if len(modules) == 0:
+                print(f'Subject {subject_id} has been processed before and its inputs did not change, skipping')
+                return None
 
-            # get the dir of the extracted toolbox
-            scli_dir = abspath('sclimbic')
+        if self.parallel_modules and len(modules) > 1:
+            threads = max(1, threads // len(modules))
 
-            # Set the paths to the files
-            t1_mgz = join(self.subjects_dir, subject_id, 'mri', 'T1.mgz')
-            sclimbic_mgz = join(self.subjects_dir, subject_id, 'mri', f'{subject_id}_sclimbic.mgz')
+        # Start the timer
+        tstart = self.ptime()
+
+        # With a scratch dir the inputs are pulled to the local disk (or were prefetched already)
+        staged = None
+        sdir = self.subjects_dir
+        find_pd = lambda r: self.find_pd(subject_id)
+        if self.scratch_dir:
+            staged = self.staged_inputs(subject_id)
+            self.prefetch(subject_id)
+            sdir = staged['sdir']
+            find_pd = lambda r: staged['pd']
 
-            # source the toolbox each time
-            process = sp.run(f'export FREESURFER_HOME={scli_dir}; \
-                source $FREESURFER_HOME/setup.sh; \
-                mri_sclimbic_seg --i {t1_mgz} --o {sclimbic_mgz} \
-                --write_volumes --write_qa_stats --etiv --threads {self.threads}', shell=True, capture_output=True)
+        # Build the graph, only the prerequisites needed by the enabled modules are added
+        prerequisites = {'PD': find_pd, 'TBX': lambda r: self.get_sclimbic()}
+        tasks, deps = {}, {}
+        for m in modules:
+            for p in self.modules[m]:
+                tasks[p] = prerequisites[p]
+            # the fingerprint of a module that was not done is taken right before it runs
+            tasks[m] = lambda r, m=m: self.run_module(m, subject_id, self.module_threads.get(m, threads), r, sdir,
+                fingerprints[m] if m in fingerprints else self.fingerprint(subject_id, m)) or None
+            deps[m] = self.modules[m]
 
-            self.log_results(subject_id, 'SCL', process)
+        self.run_graph(tasks, deps, parallel=self.parallel_modules)
+
+        if staged:
+            self.stage_out(subject_id, staged)
 
         # end time
         tend = self.ptime()
-        self.timings.append(tend-tstart)
+        with self.lock:
+            self.timings.append(tend-tstart)
         print(f'Finished segmentation on {subject_id}, it took {(tend-tstart)/60} minutes')
 
         return None
 
-    def run_list(self, subject_list):
+    def enabled_modules(self):
+        "Modules switched on for this analysis, in the order they are listed in self.modules"
+        return [m for m in self.modules if getattr(self, m.lower())]
+
+    def run_list(self, subject_list, workers=None):
         # Runs a list of subjects through all specified segmentations
+        # with workers > 1 the subjects are run concurrently and self.threads is split between them
+
+        from concurrent.futures import ThreadPoolExecutor, as_completed
 
         if len(subject_list) == 0:
             raise Exception("No subjects found in subject_list")
-        
-        self.subjects = subject_list
+
+        if workers is not None:
+            self.workers = max(1, int(workers))
+
+        self.subjects = [s if s.startswith('sub-') else f'sub-{s}' for s in subject_list]
+
+        # the fingerprints of the PD modules need the PD images, one parallel scan for the whole list
+        if self.skip_existing and any('PD' in self.modules[m] for m in self.enabled_modules()):
+            self.build_pd_index(self.subjects)
+
+        # check if sub has been processed before, for all the enabled segmentations, and that its inputs did not change
+        if self.skip_existing:
+            # a new index (first run, or started from another dir) has to learn what is on the NAS already
+            if self.state.count() == 0:
+                self.rebuild_state()
+            table = self.state.table()
+            modules = self.enabled_modules()
+            with ThreadPoolExecutor(max_workers=16) as pool:
+                todo = dict(zip(self.subjects, pool.map(lambda s: self.stale(s, modules)[0], self.subjects)))
+            done = [s for s in self.subjects if len(todo[s]) == 0]
+            changed = [s for s in self.subjects if any(table.get(s, {}).get(m) == 'done' for m in todo[s])]
+            if len(done) > 0:
+                print(f'{len(done)} subjects have been processed before, skipping')
+            if len(changed) > 0:
+                print(f'{len(changed)} subjects have inputs that changed since they were processed, these modules run again')
+            self.subjects = [s for s in self.subjects if s not in done]
+
+        # find all the problems before any compute starts
+        self.subjects = self.preflight(self.subjects)
+
+        if self.auto_tune and len(self.subjects) > 0:
+            self.tune(self.subjects, apply=True)
+
         print(f'Running segmentation on {len(self.subjects)} subjects')
 
-        # Main Loop
-        for i, subject in enumerate(self.subjects):
-            # FIXME check if sub has been processed before - need to check for all segs accordingly
-            '''
-            if self.skip_existing:
-                if self.check_exists(subject):
-                    print(f'Subject {subject} has been processed before, skipping')
-                    continue
-            '''
-            self.run_subject(subject)
+        if self.workers == 1:
+            # Main Loop
+            for i, subject in enumerate(self.subjects):
+                self.run_subject(subject)
+
+                # print progress info
+                self.progress_info(i)
+        else:
+            # Scheduler, a pool of workers each with its share of the threads budget
+            threads = self.job_threads()
+            print(f'Running {self.workers} subjects at once with {threads} threads each')
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                jobs = {pool.submit(self.run_subject, subject, threads): subject for subject in self.subjects}
+                for i, job in enumerate(as_completed(jobs)):
+                    try:
+                        job.result()
+                    except Exception as e:
+                        with self.lock, open(self.errlog, 'a') as f:
+                            f.write(f'{self.dt.now()}\t{jobs[job]}\tsegmentation crashed: {e}\n')
+                        print(f'Subject {jobs[job]} crashed: {e}')
 
-            # print progress info
-            self.progress_info(i)
+                    # print progress info
+                    self.progress_info(i)
 
         # All done!
         print(f'Finished segmentation on {len(self.subjects)} subjects')
@@ -291,7 +1985,193 @@ class seg:
             self.tgsend(f'Finished segmentation on {len(self.subjects)} subjects')
         return None
 
+    def run_queue(self, queue_path, subject_list=None, workers=None, lease=900):
+        """
+        Takes subjects from a shared work queue (see workqueue) until it is empty.
+        While other workers still hold leases the worker keeps polling (every lease/3 seconds), a subject
+        whose worker died goes back to the queue when its lease runs out and is picked up then.
+        Start this on every machine or process that should help, with the same queue_path. The subjects in
+        subject_list are added to the queue first, adding the same list again from other workers is harmless.
+        A subject counts as done when all the enabled modules are done in the state index.
+        """
+        from socket import gethostname
+        from os import getpid
+        from threading import Thread, Event
 
-        
+        if workers is not None:
+            self.workers = max(1, int(workers))
+
+        queue = workqueue(queue_path, lease=lease)
+        if self.skip_existing and self.state.count() == 0:
+            self.rebuild_state()
+        if subject_list:
+            queue.add([s if s.startswith('sub-') else f'sub-{s}' for s in subject_list])
+
+        owner = f'{gethostname()}:{getpid()}'
+        threads = self.job_threads()
+        active = set()
+        stop = Event()
+        print(f'Worker {owner} taking subjects from {queue_path}, {self.workers} at once with {threads} threads each')
+
+        # keep the leases of the running subjects alive
+        def heartbeat():
+            while not stop.wait(lease / 3):
+                with self.lock:
+                    running = list(active)
+                queue.heartbeat(owner, running)
+
+        def worker():
+            while True:
+                subject = queue.claim(owner)
+                if subject is None:
+                    counts = queue.counts()
+                    if counts.get('pending', 0) == 0 and counts.get('leased', 0) == 0:
+                        return
+                    stop.wait(lease / 3)
+                    continue
+                with self.lock:
+                    active.add(subject)
+                try:
+                    self.run_subject(subject, threads)
+                    ok = all(self.state.get(subject, m) == 'done' for m in self.enabled_modules())
+                except Exception as e:
+                    self.log_error(subject, f'segmentation crashed: {e}')
+                    print(f'Subject {subject} crashed: {e}')
+                    ok = False
+                with self.lock:
+                    active.discard(subject)
+                if not queue.complete(subject, owner, ok):
+                    print(f'Lease on {subject} was lost, another worker may have run it as well')
+                print(f'Queue: {queue.counts()}')
+
+        beat = Thread(target=heartbeat, daemon=True)
+        beat.start()
+        pool = [Thread(target=worker) for _ in range(self.workers)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        stop.set()
+
+        # All done!
+        print(f'Queue is empty: {queue.counts()}')
+        if self.telegram:
+            self.tgsend(f'Worker {owner} finished, queue: {queue.counts()}')
+        return None
+
+    def parse_volumes(self, path):
+        """
+        Reads a volume table into (measure, value) pairs.
+        The FreeSurfer txt files have a 'name volume' per line, the sclimbic csv files a header and a row of values.
+        """
+        from os.path import basename
+
+        rows = []
+        with open(path) as f:
+            lines = [line.strip() for line in f if line.strip()]
+
+        if path.endswith('.csv'):
+            header = lines[0].split(',')
+            for line in lines[1:]:
+                for name, value in zip(header, line.split(',')):
+                    try:
+                        rows.append((name.strip(), float(value)))
+                    except ValueError:
+                        pass # e.g. the subject id column
+        else:
+            # keep the hemisphere of the hippocampal/amygdala files in the measure name
+            hemi = basename(path)[:3] if basename(path)[:3] in ('lh.', 'rh.') else ''
+            for line in lines:
+                parts = line.split()
+                try:
+                    rows.append((hemi + ' '.join(parts[:-1]), float(parts[-1])))
+                except (ValueError, IndexError):
+                    pass
+        return rows
+
+    def aggregate(self, subjects=None, out_dir='.', workers=16):
+        """
+        Collects the volumes of all the modules into one cohort table for this analysis_id.
+        Each subject's mri dir is listed once, in parallel, and only the files that are new or have a different
+        mtime/size since the last run are parsed (the parsed values are cached in <analysis_id>_volumes_cache.json).
+        The long table (subject, module, file, measure, value) in <analysis_id>_volumes_long.parquet only gets
+        the subjects that changed replaced, <analysis_id>_volumes_wide.parquet has one row per subject.
+        Returns the long and the wide tables.
+        """
+        import json
+        import pandas as pd
+        from os import listdir as ls, stat, replace, makedirs
+        from os.path import join, exists
+        from fnmatch import filter as fnfilter
+        from concurrent.futures import ThreadPoolExecutor
+
+        if subjects is None:
+            subjects = [s for s in ls(self.subjects_dir) if s.startswith('sub-')]
+
+        makedirs(out_dir, exist_ok=True)
+        cache_path = join(out_dir, f'{self.analysis_id}_volumes_cache.json')
+        long_path = join(out_dir, f'{self.analysis_id}_volumes_long.parquet')
+        wide_path = join(out_dir, f'{self.analysis_id}_volumes_wide.parquet')
+
+        cache = {}
+        if exists(cache_path):
+            with open(cache_path) as f:
+                cache = json.load(f)
+
+        def collect(subject_id):
+            # returns the parsed files of the subject and whether anything changed since the cache
+            mri_dir = join(self.subjects_dir, subject_id, 'mri')
+            mri_files = ls(mri_dir) if exists(mri_dir) else []
+            parsed, changed = {}, False
+            for m, patterns in self.volumes.items():
+                for pattern in patterns:
+                    for f in fnfilter(mri_files, pattern.format(sub=subject_id, aid=self.analysis_id)):
+                        path = join(mri_dir, f)
+                        st = stat(path)
+                        key = [st.st_mtime_ns, st.st_size]
+                        entry = cache.get(path)
+                        if entry is None or entry['key'] != key:
+                            entry = {'key': key, 'subject': subject_id, 'module': m, 'file': f, 'rows': self.parse_volumes(path)}
+                            changed = True
+                        parsed[path] = entry
+            # a file that was there before and is gone now is a change as well
+            if set(p for p, e in cache.items() if e['subject'] == subject_id) != set(parsed):
+                changed = True
+            return subject_id, parsed, changed
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(collect, subjects))
+
+        changed = [s for s, _, c in results if c]
+        cache = {p: e for p, e in cache.items() if e['subject'] not in changed}
+        for s, parsed, c in results:
+            if c:
+                cache.update(parsed)
+
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump(cache, f)
+        replace(cache_path + '.tmp', cache_path)
+
+        rows = [(e['subject'], e['module'], e['file'], measure, value)
+            for e in cache.values() if e['subject'] in changed for measure, value in e['rows']]
+        new = pd.DataFrame(rows, columns=['subject', 'module', 'file', 'measure', 'value'])
+
+        if exists(long_path):
+            table = pd.read_parquet(long_path)
+            table = pd.concat([table[~table.subject.isin(changed)], new], ignore_index=True)
+        else:
+            table = new
+        print(f'Volumes: {len(changed)} of {len(subjects)} subjects new or changed, {table.subject.nunique()} in the table')
+
+        if len(changed) > 0 or not exists(wide_path):
+            table.to_parquet(long_path, index=False)
+            # the sclimbic volumes and QA stats have the same structure names, the kind of file keeps them apart
+            kind = (table.file.str.extract(r'\.([^.]+)\.csv$')[0] + '_').fillna('')
+            wide = table.assign(column=table.module + '_' + kind + table.measure).pivot_table(index='subject',
+                columns='column', values='value', aggfunc='first')
+            wide.to_parquet(wide_path)
+        else:
+            wide = pd.read_parquet(wide_path)
+
+        return table, wide
 
-    